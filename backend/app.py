@@ -12,13 +12,35 @@ from flask_cors import CORS
 import qdrant_client
 from openai import OpenAI
 from prompts.prompt import engineeredprompt
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_qdrant import Qdrant
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from routes.realtime import bp_realtime   
 from routes.ocr_routes import ocr_bp
+from utils.admission import BATCH, Overloaded, admission, admit, install_proxy_fix, session_key
+from utils.cache import TTLCache
+from utils.embeddings import build_embeddings
+from utils.history import HistoryCompactor
+from utils.recorder import recorder, trace_callback
+from utils.resilience import (
+    DeadlineChatOpenAI,
+    install_deadlines,
+    resilient_retriever,
+    set_deadline,
+    upstream,
+    upstream_stats,
+)
+from utils.shared_cache import cache_key, shared_cache, shared_cache_stats
+from utils.speculative import SpeculativeRetriever
+from utils.sse import SSE_HEADERS, document_sources, event_stream, wants_sse
+from utils.streaming import TRUNCATED_MARKER, stream_metrics
+from utils.usage import (
+    install_usage_tracking,
+    ledger,
+    record_response_usage,
+    usage_callback,
+)
 
 # Load env vars
 load_dotenv()
@@ -36,39 +58,92 @@ CORS(app, resources={
     }
 })
 
+install_proxy_fix(app)
+install_deadlines(app)
+install_usage_tracking(app, session_key)
+recorder.install(app)
 app.register_blueprint(bp_realtime, url_prefix="/api")
 chat_sessions = {}
 collection_name = os.getenv("QDRANT_COLLECTION_NAME")
 
 # Initialize OpenAI client
-client = OpenAI()
+client = OpenAI(max_retries=0)  # retries happen in Upstream.call
+
+# === CHAT HISTORY COMPACTION ===
+def summarize_history(previous_summary, messages):
+    # Runs in a copy of the request's context (for usage scoping) after the answer has
+    # streamed, so the request's deadline is mostly spent; the summary gets its own.
+    set_deadline(float(os.getenv("HISTORY_SUMMARY_DEADLINE_SECONDS", 60)))
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        "Update the running summary of an IVF training conversation. Keep the topics covered, "
+        "facts the trainee was taught, their mistakes and open questions. Be concise (under 250 words).\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+    )
+    response = upstream("openai_chat").call(lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+        model=os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini"),
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.2
+    ))
+    record_response_usage(response)
+    return response.choices[0].message.content.strip()
+
+history_compactor = HistoryCompactor(
+    summarize_history,
+    token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", 3000)),
+    keep_last=int(os.getenv("HISTORY_KEEP_LAST", 6)),
+    max_message_tokens=int(os.getenv("HISTORY_MAX_MESSAGE_TOKENS", 1500)),
+)
+
+def history_for(session_id):
+    return history_compactor.context_for(session_id, chat_sessions.get(session_id, []))
+
+def save_turn(session_id, user_content, assistant_content):
+    history = chat_sessions.setdefault(session_id, [])
+    history.append({"role": "user", "content": user_content})
+    history.append({"role": "assistant", "content": assistant_content})
+    history_compactor.maybe_compact(session_id, history)
+
 app.register_blueprint(ocr_bp)
 # === VECTOR STORE ===
 def get_vector_store():
     qdrant = qdrant_client.QdrantClient(
         url=os.getenv("QDRANT_HOST"),
         api_key=os.getenv("QDRANT_API_KEY"),
-        timeout=60.0
+        timeout=float(os.getenv("QDRANT_TIMEOUT", 10))
     )
-    embeddings = OpenAIEmbeddings()
-    return Qdrant(client=qdrant, collection_name=collection_name, embeddings=embeddings)
+    return Qdrant(client=qdrant, collection_name=collection_name, embeddings=build_embeddings())
 
 vector_store = get_vector_store()
 
 # === RAG Chain ===
+# "speculative" starts retrieval on the raw input while the rewrite runs;
+# "serial" is the plain rewrite-then-retrieve pipeline.
+retrieval_mode = os.getenv("RETRIEVAL_MODE", "speculative")
+speculative_retriever = None
+
 def get_context_retriever_chain():
-    llm = ChatOpenAI(model="gpt-4o")
-    retriever = vector_store.as_retriever()
+    global speculative_retriever
+    llm = DeadlineChatOpenAI(model="gpt-4o", callbacks=[usage_callback, trace_callback], stream_usage=True)
     prompt = ChatPromptTemplate.from_messages([
         MessagesPlaceholder("chat_history"),
         ("user", "{input}"),
         ("user", "Given the above conversation, generate a search query to look up in order to get information relevant to the conversation"),
     ])
+    if retrieval_mode == "speculative":
+        speculative_retriever = SpeculativeRetriever(
+            llm,
+            vector_store,
+            prompt,
+            similarity_threshold=float(os.getenv("SPECULATIVE_SIMILARITY_THRESHOLD", 0.9)),
+        )
+        return speculative_retriever.as_runnable()
+    retriever = resilient_retriever(vector_store)
     return create_history_aware_retriever(llm, retriever, prompt)
 
 def get_conversational_rag_chain():
     retriever_chain = get_context_retriever_chain()
-    llm = ChatOpenAI(model="gpt-4o")
+    llm = DeadlineChatOpenAI(model="gpt-4o", callbacks=[usage_callback, trace_callback], stream_usage=True)
     prompt = ChatPromptTemplate.from_messages([
         ("system", engineeredprompt),
         MessagesPlaceholder("chat_history"),
@@ -78,8 +153,12 @@ def get_conversational_rag_chain():
 
 conversation_rag_chain = get_conversational_rag_chain()
 
+# Non-streamed generations (full answers, quizzes, mind maps) need more than the default deadline.
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE_SECONDS", 90))
+
 # === /stream ===
 @app.route("/stream", methods=["POST"])
+@admit("openai_chat", "openai_embeddings", "qdrant")
 def stream():
     data = request.get_json()
     session_id = data.get("session_id", str(uuid4()))
@@ -90,33 +169,73 @@ def stream():
     if session_id not in chat_sessions:
         chat_sessions[session_id] = []
 
-    def generate():
+    def rag_events():
         answer = ""
+        stream_metrics.started("/stream")
 
         # === Pure RAG only ===
+        chain_stream = conversation_rag_chain.stream(
+            {"chat_history": history_for(session_id), "input": user_input}
+        )
         try:
-            for chunk in conversation_rag_chain.stream(
-                {"chat_history": chat_sessions[session_id], "input": user_input}
-            ):
+            for chunk in chain_stream:
+                if "context" in chunk:
+                    yield "sources", {"sources": document_sources(chunk["context"])}
                 token = chunk.get("answer", "")
-                answer += token
-                yield token
+                if token:
+                    answer += token
+                    yield "token", token
+        except GeneratorExit:
+            # Client disconnected: abort the gpt-4o stream and keep only what was sent.
+            chain_stream.close()
+            stream_metrics.cancelled("/stream", len(answer))
+            save_turn(session_id, user_input, answer + TRUNCATED_MARKER)
+            raise
         except Exception as e:
-            yield f"\n[Vector error: {str(e)}]"
+            yield "error", {"message": f"Vector error: {str(e)}"}
 
         # Save session
-        chat_sessions[session_id].append({"role": "user", "content": user_input})
-        chat_sessions[session_id].append({"role": "assistant", "content": answer})
+        stream_metrics.completed("/stream")
+        save_turn(session_id, user_input, answer)
+        yield "done", {"session_id": session_id}
+
+    cors_headers = {"Access-Control-Allow-Origin": "https://ivf-virtual-training-assistant-dsah.onrender.com"}
+
+    # SSE mode: coalesced token frames plus sources / heartbeat / error / done events
+    if wants_sse(request, data):
+        return Response(
+            stream_with_context(event_stream(
+                rag_events(),
+                max_delay=float(os.getenv("SSE_COALESCE_SECONDS", 0.05)),
+                max_chars=int(os.getenv("SSE_COALESCE_CHARS", 512)),
+                heartbeat=float(os.getenv("SSE_HEARTBEAT_SECONDS", 15)),
+            )),
+            content_type="text/event-stream",
+            headers={**cors_headers, **SSE_HEADERS}
+        )
+
+    def generate():
+        events = rag_events()
+        try:
+            for event, payload in events:
+                if event == "token":
+                    yield payload
+                elif event == "error":
+                    yield f"\n[{payload['message']}]"
+        finally:
+            events.close()  # propagates a client disconnect to rag_events
 
     return Response(
         stream_with_context(generate()),
         content_type="text/plain",
-        headers={"Access-Control-Allow-Origin": "https://ivf-virtual-training-assistant-dsah.onrender.com"}
+        headers=cors_headers
     )
 
 # === /generate ===
 @app.route("/generate", methods=["POST"])
+@admit("openai_chat", "openai_embeddings", "qdrant")
 def generate():
+    set_deadline(GENERATION_DEADLINE)
     data = request.get_json()
     session_id = data.get("session_id", str(uuid4()))
     user_input = data.get("message", "")
@@ -127,27 +246,28 @@ def generate():
         chat_sessions[session_id] = []
 
     response = conversation_rag_chain.invoke(
-        {"chat_history": chat_sessions[session_id], "input": user_input}
+        {"chat_history": history_for(session_id), "input": user_input}
     )
     answer = response["answer"]
 
-    chat_sessions[session_id].append({"role": "user", "content": user_input})
-    chat_sessions[session_id].append({"role": "assistant", "content": answer})
+    save_turn(session_id, user_input, answer)
 
     return jsonify({"response": answer, "session_id": session_id})
 
 # === /tts ===
 @app.route("/tts", methods=["POST"])
+@admit("openai_tts")
 def tts():
     text = (request.json or {}).get("text", "").strip()
     if not text:
         return jsonify({"error": "No text supplied"}), 400
 
-    response = client.audio.speech.create(
+    response = upstream("openai_tts").call(lambda timeout: client.with_options(timeout=timeout).audio.speech.create(
         model="tts-1",
         voice="fable",
         input=text
-    )
+    ))
+    ledger.record("tts", "tts-1", len(text))  # TTS is billed per character
     audio_file = "temp_audio.mp3"
     response.stream_to_file(audio_file)
     with open(audio_file, "rb") as f:
@@ -161,11 +281,17 @@ def reset():
     session_id = request.json.get("session_id")
     if session_id in chat_sessions:
         del chat_sessions[session_id]
+    history_compactor.forget(session_id)
     return jsonify({"message": "Session reset"}), 200
 
 # === /start-quiz ===
+# fresh-session quizzes are served from this many cached variants per (topic, difficulty)
+QUIZ_CACHE_VARIANTS = int(os.getenv("QUIZ_CACHE_VARIANTS", 3))
+
 @app.route("/start-quiz", methods=["POST"])
+@admit(priority=BATCH)
 def start_quiz():
+    set_deadline(GENERATION_DEADLINE)
     data = request.json
     session_id = data.get("session_id", str(uuid4()))
     topic = data.get("topic", "IVF")
@@ -179,22 +305,30 @@ def start_quiz():
         "Respond ONLY with valid JSON — no markdown, commentary, or explanations."
     )
 
-    response = conversation_rag_chain.invoke(
-        {"chat_history": chat_sessions.get(session_id, []), "input": rag_prompt}
-    )
-    raw_answer = response["answer"]
-    raw_cleaned = re.sub(r"```json|```", "", raw_answer).strip()
-    questions = json.loads(raw_cleaned)
+    def generate():
+        response = conversation_rag_chain.invoke(
+            {"chat_history": history_for(session_id), "input": rag_prompt}
+        )
+        raw_answer = response["answer"]
+        raw_cleaned = re.sub(r"```json|```", "", raw_answer).strip()
+        return raw_answer, json.loads(raw_cleaned)
+
+    if history_for(session_id):
+        raw_answer, questions = generate()
+    else:
+        # fresh sessions don't depend on history: share a few variants per topic
+        variant = random.randrange(QUIZ_CACHE_VARIANTS)
+        raw_answer, questions = shared_cache("quiz").get_or_compute(
+            cache_key(topic, difficulty, variant), generate
+        )
 
-    if session_id not in chat_sessions:
-        chat_sessions[session_id] = []
-    chat_sessions[session_id].append({"role": "user", "content": rag_prompt})
-    chat_sessions[session_id].append({"role": "assistant", "content": raw_answer})
+    save_turn(session_id, rag_prompt, raw_answer)
 
     return jsonify({"questions": questions, "session_id": session_id})
 
 # === /quiz-feedback-stream ===
 @app.route("/quiz-feedback-stream", methods=["POST"])
+@admit("openai_chat", "openai_embeddings", "qdrant")
 def quiz_feedback_stream():
     data = request.get_json()
     session_id = data.get("session_id", str(uuid4()))
@@ -212,10 +346,21 @@ def quiz_feedback_stream():
     )
 
     def generate():
-        for chunk in conversation_rag_chain.stream(
-            {"chat_history": chat_sessions.get(session_id, []), "input": full_prompt}
-        ):
-            yield chunk.get("answer", "")
+        sent = 0
+        stream_metrics.started("/quiz-feedback-stream")
+        chain_stream = conversation_rag_chain.stream(
+            {"chat_history": history_for(session_id), "input": full_prompt}
+        )
+        try:
+            for chunk in chain_stream:
+                token = chunk.get("answer", "")
+                sent += len(token)
+                yield token
+        except GeneratorExit:
+            chain_stream.close()
+            stream_metrics.cancelled("/quiz-feedback-stream", sent)
+            raise
+        stream_metrics.completed("/quiz-feedback-stream")
 
     return Response(stream_with_context(generate()), content_type="text/plain")
 
@@ -248,7 +393,9 @@ def quiz_performance():
 
 # === /suggestions ===
 @app.route("/suggestions", methods=["GET"])
+@admit(priority=BATCH)
 def suggestions():
+    set_deadline(GENERATION_DEADLINE)
     # --- SOLUTION ---
     # 1. Create a list of different prompts
     prompt_templates = [
@@ -263,12 +410,11 @@ def suggestions():
     random_prompt = random.choice(prompt_templates)
     # --- END SOLUTION ---
 
-    response = conversation_rag_chain.invoke({
+    raw = shared_cache("suggestions").get_or_compute(cache_key(random_prompt), lambda: conversation_rag_chain.invoke({
         "chat_history": [],
         "input": random_prompt # Use the randomized prompt here
-    })
-    
-    raw = response.get("answer", "")
+    }).get("answer", ""))
+
     lines = raw.split("\n")
     questions = [re.sub(r"^[\s•\-\d\.\)]+", "", line).strip() for line in lines if line.strip()]
     
@@ -276,7 +422,9 @@ def suggestions():
 
 # === /mindmap ===
 @app.route("/mindmap", methods=["POST"])
+@admit(priority=BATCH)
 def mindmap():
+    set_deadline(GENERATION_DEADLINE)
     session_id = request.json.get("session_id", str(uuid4()))
     topic = request.json.get("topic", "IVF")
 
@@ -285,22 +433,30 @@ def mindmap():
         f"Use a valid JSON tree structure, no markdown or comments."
     )
 
-    response = conversation_rag_chain.invoke(
-        {"chat_history": chat_sessions.get(session_id, []), "input": rag_prompt}
-    )
-    raw_cleaned = re.sub(r"```json|```", "", response["answer"]).strip()
-    nodes = json.loads(raw_cleaned)
+    def generate():
+        response = conversation_rag_chain.invoke(
+            {"chat_history": history_for(session_id), "input": rag_prompt}
+        )
+        raw_cleaned = re.sub(r"```json|```", "", response["answer"]).strip()
+        return json.loads(raw_cleaned)
+
+    if history_for(session_id):
+        nodes = generate()
+    else:
+        nodes = shared_cache("chain").get_or_compute(cache_key("mindmap", topic), generate)
 
     return jsonify({"nodes": nodes, "session_id": session_id})
 
 # === /diagram ===
 @app.route("/diagram", methods=["POST"])
+@admit(priority=BATCH)
 def diagram():
     """
     Generates valid Mermaid code using OpenAI,
     extracts only the mermaid block,
     removes numbers inside square brackets.
     """
+    set_deadline(GENERATION_DEADLINE)
     session_id = request.json.get("session_id", str(uuid4()))
     topic = request.json.get("topic", "IVF Process Diagram")
 
@@ -317,11 +473,19 @@ def diagram():
     )
 
     # Call OpenAI chat completion
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "user", "content": prompt}]
+    def generate():
+        response = upstream("openai_chat").call(lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": prompt}]
+        ))
+        record_response_usage(response)
+        return response.choices[0].message.content
+
+    # only cache answers that actually contain a diagram
+    raw_answer = shared_cache("chain").get_or_compute(
+        cache_key("diagram", topic), generate,
+        should_cache=lambda answer: re.search(r"```mermaid", answer, re.IGNORECASE) is not None,
     )
-    raw_answer = response.choices[0].message.content
 
     # Extract Mermaid code
     match = re.search(r"```mermaid([\s\S]+?)```", raw_answer, re.IGNORECASE)
@@ -336,7 +500,59 @@ def diagram():
         "topic": topic
     })
 
+# === /websearch_trend ===
+# Trend answers barely move within a day, so cache them by normalized query and
+# refresh stale entries in the background instead of re-running web search.
+trend_cache = TTLCache(
+    ttl=float(os.getenv("TREND_CACHE_TTL", 24 * 3600)),
+    stale_ttl=float(os.getenv("TREND_CACHE_STALE_TTL", 7 * 24 * 3600)),
+    max_entries=int(os.getenv("TREND_CACHE_MAX_ENTRIES", 512)),
+)
+
+def normalize_trend_query(query):
+    return re.sub(r"\s+", " ", query.lower()).strip(" \t\n?!.,;:")
+
+def fetch_trend(user_input):
+    """Runs the web-search call and returns (payload, status_code)."""
+    # Web search is slow by nature; it gets its own budget (also on background refreshes).
+    set_deadline(float(os.getenv("TREND_DEADLINE_SECONDS", 90)))
+    # Use OpenAI Responses API with web search tool
+    stream = upstream("openai_chat").call(lambda timeout: client.with_options(timeout=timeout).responses.create(
+        model="gpt-4o",
+        tools=[{"type": "web_search_preview"}],
+        input=(
+            f"For this query: '{user_input}', "
+            f"search the web and return two fields:\n"
+            f"1. A short explanation of the trend (under 400 characters).\n"
+            f"2. A valid Highcharts JSON config using column or line chart.\n\n"
+            f"Respond as a JSON object with two fields: 'explanation' and 'chartConfig'."
+        )
+    ))
+
+    # Convert the result to usable JSON
+    record_response_usage(stream)
+    raw_output = stream.output_text.strip()
+    try:
+        # Attempt to parse directly
+        json_match = re.search(r"{.*}", raw_output, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group()), 200
+        return {"error": "No JSON found in response", "raw": raw_output}, 400
+    except json.JSONDecodeError:
+        return {"error": "Malformed JSON in response", "raw": raw_output}, 400
+
+def is_valid_trend(result):
+    payload, status = result
+    return (
+        status == 200
+        and isinstance(payload, dict)
+        and isinstance(payload.get("explanation"), str)
+        and bool(payload["explanation"].strip())
+        and isinstance(payload.get("chartConfig"), dict)
+    )
+
 @app.route("/websearch_trend", methods=["POST"])
+@admit(priority=BATCH)
 def websearch_trend():
     try:
         data = request.get_json()
@@ -345,36 +561,57 @@ def websearch_trend():
         if not user_input:
             return jsonify({"error": "No query provided"}), 400
 
-        # Use OpenAI Responses API with web search tool
-        stream = client.responses.create(
-            model="gpt-4o",
-            tools=[{"type": "web_search_preview"}],
-            input=(
-                f"For this query: '{user_input}', "
-                f"search the web and return two fields:\n"
-                f"1. A short explanation of the trend (under 400 characters).\n"
-                f"2. A valid Highcharts JSON config using column or line chart.\n\n"
-                f"Respond as a JSON object with two fields: 'explanation' and 'chartConfig'."
-            )
+        payload, status = trend_cache.get_or_compute(
+            normalize_trend_query(user_input),
+            lambda: fetch_trend(user_input),
+            should_cache=is_valid_trend,
         )
+        return jsonify(payload), status
 
-        # Convert the result to usable JSON
-        raw_output = stream.output_text.strip()
-        try:
-            # Attempt to parse directly
-            json_match = re.search(r"{.*}", raw_output, re.DOTALL)
-            if json_match:
-                parsed = json.loads(json_match.group())
-                return jsonify(parsed), 200
-            else:
-                return jsonify({"error": "No JSON found in response", "raw": raw_output}), 400
-        except json.JSONDecodeError:
-            return jsonify({"error": "Malformed JSON in response", "raw": raw_output}), 400
-
+    except Overloaded:
+        raise  # admit turns it into a 429
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+# === /retrieval-stats ===
+@app.route("/retrieval-stats", methods=["GET"])
+def retrieval_stats():
+    if speculative_retriever is None:
+        return jsonify({"mode": retrieval_mode})
+    return jsonify({"mode": retrieval_mode, **speculative_retriever.report()})
+
+# === /cache-stats ===
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return jsonify({"shared": shared_cache_stats(), "websearch_trend": {**trend_cache.stats, "entries": len(trend_cache)}})
+
+# === /admission-stats ===
+@app.route("/admission-stats", methods=["GET"])
+def admission_stats():
+    return jsonify(admission.snapshot())
+
+# === /stream-stats ===
+@app.route("/stream-stats", methods=["GET"])
+def stream_stats():
+    return jsonify(stream_metrics.snapshot())
+
+# === /usage ===
+@app.route("/usage", methods=["GET"])
+def usage():
+    group_by = request.args.get("group_by", "endpoint")
+    if group_by not in ("endpoint", "session", "model", "kind"):
+        return jsonify({"error": "group_by must be endpoint, session, model or kind"}), 400
+    since = request.args.get("since", type=float)
+    return jsonify({"group_by": group_by, "usage": ledger.summary(group_by, since)})
+
+# === /upstream-stats ===
+@app.route("/upstream-stats", methods=["GET"])
+def upstream_health():
+    return jsonify(upstream_stats())
+
 # === /generate-followups ===
 @app.route("/generate-followups", methods=["POST"])
+@admit(priority=BATCH)
 def generate_followups():
     data = request.get_json()
     last_answer = data.get("last_answer", "")
@@ -388,15 +625,16 @@ def generate_followups():
     )
 
     try:
-        completion = client.chat.completions.create(
+        completion = upstream("openai_chat").call(lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": followup_prompt}
             ],
             temperature=0.7
-        )
+        ))
 
+        record_response_usage(completion)
         text = completion.choices[0].message.content.strip()
         match = re.search(r'\[(.*?)\]', text, re.DOTALL)
         questions = json.loads(f"[{match.group(1)}]") if match else []
@@ -1,17 +1,24 @@
 from flask import Flask, request, jsonify, stream_with_context, Response
 from flask_cors import CORS
-from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.messages import AIMessage, HumanMessage
 from dotenv import load_dotenv
+import hashlib
 import os
 import tempfile
 from openai import OpenAI
+from utils.pdf_ingest import dedup_chunks, parse_pdf_parallel
+from utils.library import UserLibrary
+from utils.recorder import recorder, trace_callback
+from utils.streaming import TRUNCATED_MARKER, stream_metrics
+from utils.admission import BATCH, Overloaded, admit, install_proxy_fix, session_key
+from utils.embeddings import build_embeddings
+from utils.resilience import DeadlineChatOpenAI, install_deadlines, set_deadline
+from utils.shared_cache import cache_key, shared_cache, shared_cache_stats
+from utils.usage import install_usage_tracking, usage_callback
 
 load_dotenv()
 
@@ -19,12 +26,20 @@ app = Flask(__name__)
 CORS(app, origins=["https://ivfvirtualtrainingassistantdsah.onrender.com","https://ivf-virtual-training-assistant-dsah.onrender.com"])
 
 chat_histories = {}
-vector_stores = {}
-client = OpenAI()
+libraries = {}  # user_id -> UserLibrary
+client = OpenAI(max_retries=0)
+install_proxy_fix(app)
+install_deadlines(app)
+install_usage_tracking(app, session_key)
+recorder.install(app)
 
 # ✅ Chunking configuration
-chunk_size = 1000
-chunk_overlap = 300
+chunk_size = int(os.getenv("CHUNK_SIZE", 1000))
+chunk_overlap = int(os.getenv("CHUNK_OVERLAP", 300))
+
+# ✅ Ingest configuration
+ingest_workers = int(os.getenv("INGEST_WORKERS", 0)) or None  # None = all cores
+dedup_threshold = float(os.getenv("DEDUP_THRESHOLD", 0.9))
 
 def get_chunks(documents):
     text_splitter = RecursiveCharacterTextSplitter(
@@ -33,15 +48,27 @@ def get_chunks(documents):
     )
     return text_splitter.split_documents(documents)
 
-def get_vectorestore_from_path(file_path):
-    loader = PyPDFLoader(file_path)
-    documents = loader.load()
-    chunks = get_chunks(documents)
-    return FAISS.from_documents(chunks, OpenAIEmbeddings())
+def get_chunks_from_path(file_path):
+    documents, parse_stats = parse_pdf_parallel(file_path, workers=ingest_workers)
+    chunks, dedup_stats = dedup_chunks(get_chunks(documents), threshold=dedup_threshold)
+    ingest_stats = {**parse_stats, **dedup_stats}
+    print(f"[INGEST] {file_path}: {ingest_stats}")
+    return chunks, ingest_stats
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-def get_context_retriever_chain(vector_store):
-    llm = ChatOpenAI()
-    retriever = vector_store.as_retriever()
+def get_library(user_id):
+    if user_id not in libraries:
+        libraries[user_id] = UserLibrary(build_embeddings())
+    return libraries[user_id]
+
+def get_context_retriever_chain(retriever):
+    llm = DeadlineChatOpenAI(callbacks=[usage_callback, trace_callback], stream_usage=True)
     prompt = ChatPromptTemplate.from_messages([
         MessagesPlaceholder(variable_name="chat_history"),
         ("user", "{input}"),
@@ -50,7 +77,7 @@ def get_context_retriever_chain(vector_store):
     return create_history_aware_retriever(llm, retriever, prompt)
 
 def get_conversational_rag_chain(retriever_chain):
-    llm = ChatOpenAI()
+    llm = DeadlineChatOpenAI(callbacks=[usage_callback, trace_callback], stream_usage=True)
     prompt = ChatPromptTemplate.from_messages([
         ("system", "Answer the user's question  please answer them with more delails and high specificity given the below context:\n\n{context} use markdowns for detailed and enumerated answers with bold texts."),
         MessagesPlaceholder(variable_name="chat_history"),
@@ -60,40 +87,70 @@ def get_conversational_rag_chain(retriever_chain):
     return create_retrieval_chain(retriever_chain, stuff_chain)
 
 @app.route('/chatwithbooks/upload', methods=['POST'])
+@admit(priority=BATCH)
 def upload_pdf():
     file = request.files['file']
     user_id = request.form.get("user_id", "default_user")
+    # Parsing and embedding a whole book takes far longer than a chat turn.
+    set_deadline(float(os.getenv("UPLOAD_DEADLINE_SECONDS", 600)))
 
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
             file.save(tmp.name)
 
             # ✅ Step 1: Chunking before embedding
-            vector_store = get_vectorestore_from_path(tmp.name)
-            vector_stores[user_id] = vector_store
-            chat_histories[user_id] = [
-                AIMessage(content="Hello! I'm your book assistant. How can I help you today?")
-            ]
-
-            # ✅ Step 2: Generate suggested questions using RAG
-            retriever_chain = get_context_retriever_chain(vector_store)
+            # The same textbook is often uploaded by many users: parsing,
+            # embeddings and suggestions are all shared across workers by file hash.
+            file_hash = file_sha256(tmp.name)
+            chunks, ingest_stats = shared_cache("ingest").get_or_compute(
+                cache_key(file_hash, chunk_size, chunk_overlap, dedup_threshold),
+                lambda: get_chunks_from_path(tmp.name)
+            )
+
+            if not chunks:
+                # e.g. a scanned book without a text layer
+                return jsonify({
+                    "embedding_done": False,
+                    "error": "No text found in this PDF.",
+                    "ingest_stats": ingest_stats
+                }), 400
+
+            # Only the new document is embedded; earlier books stay in the index.
+            library = get_library(user_id)
+            document_id = library.add_document(
+                file.filename or "document.pdf", chunks, pages=ingest_stats["pages"]
+            )
+            if not chat_histories.get(user_id):
+                chat_histories[user_id] = [
+                    AIMessage(content="Hello! I'm your book assistant. How can I help you today?")
+                ]
+
+            # ✅ Step 2: Generate suggested questions using RAG (for the new document)
+            retriever = library.as_retriever({"document_ids": [document_id]})
+            retriever_chain = get_context_retriever_chain(retriever)
             conversation_chain = get_conversational_rag_chain(retriever_chain)
 
-            response = conversation_chain.invoke({
+            answer = shared_cache("suggestions").get_or_compute(cache_key("book", file_hash), lambda: conversation_chain.invoke({
                 "chat_history": [],
                 "input": "Suggest 25 questions to understand this book better and summarize key sections."
-            })
+            }).get("answer", ""))
 
-            suggestions = response.get("answer", "").split("\n")
+            suggestions = answer.split("\n")
             questions = [q.strip("•- 1234567890.") for q in suggestions if q.strip()]
 
             # ✅ Step 3: Return signal to frontend
             return jsonify({
                 "embedding_done": True,
                 "message": "Embedding completed successfully.",
-                "suggested_questions": questions[:25]
+                "suggested_questions": questions[:25],
+                "ingest_stats": ingest_stats,
+                "document_id": document_id,
+                "documents": library.list_documents(),
+                "index_stats": library.stats()
             }), 200
 
+    except Overloaded:
+        raise  # admit turns it into a 429
     except Exception as e:
         print(f"[ERROR] Upload failed: {e}")
         return jsonify({
@@ -103,26 +160,48 @@ def upload_pdf():
         }), 500
 
 @app.route('/chatwithbooks/message', methods=['POST'])
+@admit("openai_embeddings", "openai_chat")
 def chat_message():
     data = request.get_json()
     user_input = data['message']
     user_id = data.get('user_id', 'default_user')
+    # Optional scope: {"document_ids": [...], "chapter": "...", "page_range": [first, last]}
+    filters = data.get('filters')
 
-    if user_id not in chat_histories or user_id not in vector_stores:
+    library = libraries.get(user_id)
+    if user_id not in chat_histories or library is None or library.is_empty():
         return jsonify({"error": "No vector store found. Please upload a PDF first."}), 400
 
-    chat_history = chat_histories[user_id]
-    vector_store = vector_stores[user_id]
-    retriever_chain = get_context_retriever_chain(vector_store)
+    try:
+        retriever = library.as_retriever(filters)
+    except ValueError as e:
+        # validated here: once streaming starts the 200 is already sent
+        return jsonify({"error": str(e)}), 400
+
+    chat_history = list(chat_histories[user_id])
+    retriever_chain = get_context_retriever_chain(retriever)
     conversation_chain = get_conversational_rag_chain(retriever_chain)
 
     def generate():
-        for chunk in conversation_chain.stream({
+        answer = ""
+        stream_metrics.started("/chatwithbooks/message")
+        chain_stream = conversation_chain.stream({
             "chat_history": chat_history,
             "input": user_input
-        }):
-            content = chunk.get("answer", "")
-            yield content
+        })
+        try:
+            for chunk in chain_stream:
+                content = chunk.get("answer", "")
+                answer += content
+                yield content
+        except GeneratorExit:
+            # Client disconnected: stop the upstream stream and keep the partial answer.
+            chain_stream.close()
+            stream_metrics.cancelled("/chatwithbooks/message", len(answer))
+            chat_histories[user_id].append(AIMessage(content=answer + TRUNCATED_MARKER))
+            raise
+        stream_metrics.completed("/chatwithbooks/message")
+        chat_histories[user_id].append(AIMessage(content=answer))
 
     chat_histories[user_id].append(HumanMessage(content=user_input))
     return Response(stream_with_context(generate()), content_type='text/plain')
@@ -131,9 +210,47 @@ def chat_message():
 def reset_chat():
     user_id = request.form.get("user_id", "default_user")
     chat_histories[user_id] = []
-    vector_stores.pop(user_id, None)
+    libraries.pop(user_id, None)
     return jsonify({"message": "Session reset."})
 
+@app.route('/chatwithbooks/documents', methods=['GET'])
+def list_documents():
+    user_id = request.args.get("user_id", "default_user")
+    library = libraries.get(user_id)
+    return jsonify({
+        "documents": library.list_documents() if library else [],
+        "index_stats": library.stats() if library else {}
+    })
+
+@app.route('/chatwithbooks/stream-stats', methods=['GET'])
+def chat_stream_stats():
+    return jsonify(stream_metrics.snapshot())
+
+@app.route('/chatwithbooks/cache-stats', methods=['GET'])
+def chat_cache_stats():
+    return jsonify(shared_cache_stats())
+
+@app.route('/chatwithbooks/index-stats', methods=['GET'])
+def index_stats():
+    per_user = {user_id: library.stats() for user_id, library in list(libraries.items())}
+    return jsonify({
+        "libraries": len(per_user),
+        "memory_bytes": sum(s.get("memory_bytes", 0) for s in per_user.values()),
+        "flat_memory_bytes": sum(s.get("flat_memory_bytes", 0) for s in per_user.values()),
+        "per_user": per_user
+    })
+
+@app.route('/chatwithbooks/remove', methods=['POST'])
+def remove_document():
+    data = request.get_json()
+    user_id = data.get("user_id", "default_user")
+    document_id = data.get("document_id")
+
+    library = libraries.get(user_id)
+    if library is None or not library.remove_document(document_id):
+        return jsonify({"error": "Document not found."}), 404
+    return jsonify({"message": "Document removed.", "documents": library.list_documents()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 
@@ -0,0 +1,125 @@
+"""
+Replays traces written by the recorder (RECORD_TRAFFIC=1, see utils/recorder.py)
+against the current code and reports latency deltas and retrieval overlap.
+
+Chat model calls are served from the recordings, at the recorded pace unless
+--no-latency is given. Retrieval runs live against Qdrant by default, which is
+what the recall@k numbers measure; --stub-retrieval serves the recorded
+documents as well, for a fully offline latency comparison.
+
+    python replay.py traces/traces.jsonl* [--k 4] [--stub-retrieval] [--out report.json]
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import tempfile
+
+
+def load_traces(patterns):
+    traces = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, encoding="utf-8") as f:
+                traces.extend(json.loads(line) for line in f if line.strip())
+    # recorded order, so per-session chat history builds up as it did live
+    return sorted(traces, key=lambda t: t["ts"])
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+
+def summarize(rows):
+    deltas = [r["total_delta"] for r in rows if r["total_delta"] is not None]
+    ttft = [r["first_token_delta"] for r in rows if r["first_token_delta"] is not None]
+    recalls = [r["recall_at_k"] for r in rows if r["recall_at_k"] is not None]
+    return {
+        "traces": len(rows),
+        "total_delta_mean": statistics.mean(deltas) if deltas else None,
+        "total_delta_p50": percentile(deltas, 0.5),
+        "total_delta_p95": percentile(deltas, 0.95),
+        "first_token_delta_mean": statistics.mean(ttft) if ttft else None,
+        "recall_at_k_mean": statistics.mean(recalls) if recalls else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", nargs="+", help="trace files or glob patterns")
+    parser.add_argument("--k", type=int, default=4, help="k for recall@k (default 4)")
+    parser.add_argument("--stub-retrieval", action="store_true", help="serve recorded documents instead of Qdrant")
+    parser.add_argument("--no-latency", action="store_true", help="do not replay recorded upstream latency")
+    parser.add_argument("--out", help="write the full report as JSON")
+    args = parser.parse_args()
+
+    # The replay must not be throttled, billed to the real ledger, re-recorded
+    # to disk or answered from the shared cache.
+    os.environ["RECORD_TRAFFIC"] = "1"
+    os.environ["SHARED_CACHE_ENABLED"] = "0"
+    os.environ.setdefault("SESSION_RATE_PER_MINUTE", "1000000")
+    os.environ.setdefault("SESSION_RATE_BURST", "1000000")
+    os.environ.setdefault("USAGE_LEDGER_PATH", os.path.join(tempfile.mkdtemp(), "usage_ledger.jsonl"))
+
+    from utils import replay as stubs
+    stubs.install(stub_retrieval=args.stub_retrieval, simulate_latency=not args.no_latency)
+
+    import app as server
+    from utils.recorder import recorder
+
+    # history compaction calls OpenAI directly, outside the stubbed chat model
+    server.history_compactor.summarize = stubs.replay_summary
+
+    collected = []
+    recorder.sink = collected.append
+    client = server.app.test_client()
+
+    rows, skipped = [], 0
+    for trace in load_traces(args.traces):
+        if trace["endpoint"] not in stubs.REPLAYABLE:
+            skipped += 1
+            continue
+        collected.clear()
+        with stubs.replaying(trace):
+            response = client.post(trace["endpoint"], json=trace["inputs"])
+            response.get_data()
+            response.close()
+        replayed = collected[0] if collected else {"timings": {}, "retrieved_ids": []}
+
+        recorded_t, replayed_t = trace["timings"], replayed["timings"]
+        rows.append({
+            "id": trace["id"],
+            "endpoint": trace["endpoint"],
+            "status": response.status_code,
+            "total_recorded": recorded_t.get("total"),
+            "total_replayed": replayed_t.get("total"),
+            "total_delta": None if recorded_t.get("total") is None or replayed_t.get("total") is None
+            else round(replayed_t["total"] - recorded_t["total"], 4),
+            "first_token_delta": None if recorded_t.get("first_token") is None or replayed_t.get("first_token") is None
+            else round(replayed_t["first_token"] - recorded_t["first_token"], 4),
+            "recall_at_k": stubs.recall_at_k(trace.get("retrieved_ids", []), replayed.get("retrieved_ids", []), args.k),
+        })
+
+    endpoints = sorted({r["endpoint"] for r in rows})
+    report = {
+        "overall": summarize(rows),
+        "by_endpoint": {e: summarize([r for r in rows if r["endpoint"] == e]) for e in endpoints},
+        "skipped": skipped,
+        "traces": rows,
+    }
+
+    print(f"Replayed {len(rows)} traces ({skipped} skipped, endpoint not replayable)")
+    for name, summary in [("overall", report["overall"]), *report["by_endpoint"].items()]:
+        print(f"  {name:<24} " + "  ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in summary.items()
+        ))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
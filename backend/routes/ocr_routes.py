@@ -1,23 +1,27 @@
 from flask import Blueprint, request, jsonify
-import requests
 import os
+from utils.admission import admit
+from utils.resilience import http_post
 
 ocr_bp = Blueprint('ocr', __name__)
 OCR_SPACE_API_KEY = os.getenv("OCR_SPACE_API_KEY")  # Make sure it's in your .env
 
 @ocr_bp.route("/ocr", methods=["POST"])
+@admit("ocr_space")
 def ocr_from_image():
     if 'image' not in request.files:
         return jsonify({"error": "No image file uploaded"}), 400
 
     image_file = request.files['image']
+    image_bytes = image_file.read()  # read once so retries can resend it
 
     try:
-        response = requests.post(
+        response = http_post(
+            "ocr_space",
             'https://api.ocr.space/parse/image',
             files={'file': (
                         'upload.png',  # <-- force a valid filename
-                        image_file,
+                        image_bytes,
                         image_file.content_type or 'image/png'  # <-- force valid MIME type
                     )},
             data={
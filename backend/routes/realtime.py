@@ -1,10 +1,13 @@
 from flask import Blueprint, jsonify, request
 from openai import OpenAI
 import os
+from utils.admission import admit
+from utils.resilience import upstream
 
 bp_realtime = Blueprint("realtime_routes", __name__)
 
 @bp_realtime.get("/realtime-key")
+@admit("openai_chat")
 def get_realtime_key():
     """
     Creates a realtime session and returns the short‑lived client_secret.
@@ -13,13 +16,13 @@ def get_realtime_key():
     model = request.args.get("model", "gpt-4o-realtime-preview-2024-12-17")
     voice = request.args.get("voice", "alloy")
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    session = client.beta.realtime.sessions.create(
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    session = upstream("openai_realtime").call(lambda timeout: client.with_options(timeout=timeout).beta.realtime.sessions.create(
         model=model,
         voice=voice,
         turn_detection={"type": "server_vad", "threshold": 0.5},
         output_audio_format="pcm16"
-    )
+    ))
 
     return jsonify(
         client_secret=session.client_secret.value,
@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from utils.admission import (
+    BATCH,
+    INTERACTIVE,
+    AdmissionController,
+    Overloaded,
+    UpstreamPool,
+    admit,
+    install_proxy_fix,
+)
+
+
+def _remote_addr(trusted):
+    app = flask.Flask(__name__)
+    install_proxy_fix(app, trusted)
+    app.add_url_rule("/addr", "addr", lambda: flask.request.remote_addr, methods=["POST"])
+    response = app.test_client().post(
+        "/addr", headers={"X-Forwarded-For": "6.6.6.6, 10.0.0.7"},
+        environ_base={"REMOTE_ADDR": "10.0.0.1"},
+    )
+    return response.get_data(as_text=True)
+
+
+def test_forwarded_for_is_ignored_without_a_trusted_proxy():
+    assert _remote_addr(trusted=0) == "10.0.0.1"
+
+
+def test_remote_addr_is_the_hop_added_by_the_trusted_proxy():
+    assert _remote_addr(trusted=1) == "10.0.0.7"
+
+
+def _admitted_app(controller, *upstreams, priority=INTERACTIVE, view=lambda: "ok"):
+    app = flask.Flask(__name__)
+    app.add_url_rule(
+        "/work", "work", admit(*upstreams, priority=priority, controller=controller)(view), methods=["POST"]
+    )
+    return app.test_client()
+
+
+def test_only_requests_with_a_session_are_rate_limited():
+    controller = AdmissionController(limits={"upstream": 4}, rate_per_minute=1, burst=1)
+    client = _admitted_app(controller)
+    assert [client.post("/work").status_code for _ in range(3)] == [200, 200, 200]
+    statuses = [client.post("/work", json={"session_id": "s1"}).status_code for _ in range(2)]
+    assert statuses == [200, 429]
+
+
+def test_unlisted_upstreams_take_a_slot_per_call():
+    controller = AdmissionController(limits={"upstream": 1}, batch_wait=0.1)
+    pool = controller.pools["upstream"]
+    active = []
+
+    def view():
+        active.append(pool.active)
+        with controller.slot("upstream"):
+            active.append(pool.active)
+        return "ok"
+
+    client = _admitted_app(controller, priority=BATCH, view=view)
+    assert client.post("/work").status_code == 200
+    assert active == [0, 1]
+    assert pool.active == 0
+
+
+def test_overload_inside_the_view_is_a_429():
+    def view():
+        raise Overloaded("upstream queue is full", 3)
+
+    response = _admitted_app(AdmissionController(limits={"upstream": 1}), view=view).post("/work")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+
+
+def test_listed_upstreams_are_held_for_the_whole_response():
+    controller = AdmissionController(limits={"upstream": 1})
+    pool = controller.pools["upstream"]
+    active = []
+
+    def view():
+        with controller.slot("upstream"):  # already held by the route: no second slot
+            active.append(pool.active)
+        return "ok"
+
+    response = _admitted_app(controller, "upstream", view=view).post("/work")
+    assert pool.active == 1  # until the response is closed
+    response.close()
+    assert active == [1]
+    assert pool.active == 0
+
+
+def test_batch_work_leaves_headroom_for_interactive():
+    pool = UpstreamPool("test", limit=2, max_queue=4, batch_share=0.5)
+    pool.acquire(BATCH, timeout=0.1)
+    with pytest.raises(Overloaded):
+        pool.acquire(BATCH, timeout=0.1)  # batch may only hold one of the two slots
+    pool.acquire(INTERACTIVE, timeout=0.1)
+
+
+def test_interactive_waiters_are_served_before_batch():
+    pool = UpstreamPool("test", limit=1, max_queue=4, batch_share=1.0)
+    held = pool.acquire(INTERACTIVE, timeout=0.1)
+    order = []
+
+    def wait(priority):
+        pool.acquire(priority, timeout=5)
+        order.append(priority)
+        pool.release(priority, held)
+
+    batch = threading.Thread(target=wait, args=(BATCH,))
+    batch.start()
+    while not pool.queued[BATCH]:
+        pass
+    interactive = threading.Thread(target=wait, args=(INTERACTIVE,))
+    interactive.start()
+    while not pool.queued[INTERACTIVE]:
+        pass
+    pool.release(INTERACTIVE, held)
+    batch.join(5)
+    interactive.join(5)
+    assert order == [INTERACTIVE, BATCH]
@@ -0,0 +1,53 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_community")
+
+from langchain_core.documents import Document
+
+from utils.library import UserLibrary
+
+
+class FakeEmbeddings:
+    def __init__(self, dim=32):
+        self.dim = dim
+        self.rng = np.random.default_rng(0)
+        self.vectors = {}
+
+    def embed_query(self, text):
+        if text not in self.vectors:
+            self.vectors[text] = self.rng.standard_normal(self.dim).astype("float32").tolist()
+        return self.vectors[text]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def _chunks(prefix, n):
+    return [Document(page_content=f"{prefix}-{i}", metadata={"page": i}) for i in range(n)]
+
+
+@pytest.mark.parametrize("index_type", ["sq8", "ivfpq"])
+def test_filter_on_a_small_document_still_finds_its_chunks(index_type):
+    library = UserLibrary(FakeEmbeddings(), index_type=index_type)
+    library.add_document("big", _chunks("big", 2000))
+    small = library.add_document("small", _chunks("small", 5))
+
+    docs = library.as_retriever({"document_ids": [small]}).invoke("big-1")
+    assert len(docs) == 4
+    assert all(doc.metadata["document_id"] == small for doc in docs)
+
+    docs = library.as_retriever({"document_ids": [small], "page_range": [2, 3]}).invoke("big-1")
+    assert sorted(doc.page_content for doc in docs) == ["small-1", "small-2"]
+
+
+def test_filters_follow_removals():
+    library = UserLibrary(FakeEmbeddings(), index_type="sq8")
+    first = library.add_document("first", _chunks("first", 50))
+    second = library.add_document("second", _chunks("second", 50))
+    library.remove_document(first)
+
+    docs = library.as_retriever({"document_ids": [second]}).invoke("second-7")
+    assert docs[0].page_content == "second-7"
+    assert library.as_retriever({"document_ids": [first]}).invoke("second-7") == []
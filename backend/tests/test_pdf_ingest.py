@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pypdf")
+
+from langchain_core.documents import Document
+
+from utils.pdf_ingest import dedup_chunks
+
+TABLE = (
+    "Protocol outcomes by age group. Women under 35: clinical pregnancy rate {0}% per transfer, "
+    "live birth rate {1}% per cycle, recommended starting dose of {2} IU FSH daily for ten days, "
+    "monitoring by ultrasound every second day until the lead follicle reaches eighteen millimetres."
+)
+
+
+def test_chunks_that_differ_only_in_numbers_are_kept():
+    chunks = [Document(page_content=TABLE.format(*values)) for values in [(45, 38, 150), (32, 27, 225)]]
+    kept, stats = dedup_chunks(chunks)
+    assert len(kept) == 2
+    assert stats["exact_duplicates"] == stats["near_duplicates"] == 0
+
+
+def test_repeated_chunks_are_dropped():
+    text = TABLE.format(45, 38, 150)
+    chunks = [Document(page_content=text), Document(page_content=text.upper()),
+              Document(page_content=text.replace("millimetres", "millimeters"))]
+    kept, stats = dedup_chunks(chunks)
+    assert kept == chunks[:1]
+    assert stats["exact_duplicates"] == 1
+    assert stats["near_duplicates"] == 1
@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from utils.deadline import set_deadline
+from utils.shared_cache import MISS, SharedCache
+
+fork = multiprocessing.get_context("fork")
+
+
+@pytest.fixture
+def directory(tmp_path):
+    path = tmp_path / "cache"
+    path.mkdir(mode=0o700)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def deadline():
+    set_deadline(30)
+
+
+def test_roundtrip_and_compression(directory):
+    cache = SharedCache("t", 1 << 20, directory=directory)
+    cache.set("small", {"a": 1})
+    cache.set("large", "x" * 100_000)  # compressed above 1 KiB
+    assert cache.get("small") == {"a": 1}
+    assert cache.get("large") == "x" * 100_000
+    assert cache.get("absent") is MISS
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_ring_wraps_and_drops_the_oldest_records(directory):
+    cache = SharedCache("t", 64 * 1024, directory=directory, slots=64)
+    values = {f"k{i}": os.urandom(4000) for i in range(40)}  # ~160 KB through a ~60 KB ring
+    for key, value in values.items():
+        assert cache.set(key, value)
+
+    assert cache.get("k0") is MISS  # overwritten by the wrap, caught by the key/CRC check
+    assert cache.get("k39") == values["k39"]
+    survivors = [key for key, value in values.items() if cache.get(key) == value]
+    assert 0 < len(survivors) < len(values)
+    # only a contiguous tail of the most recent writes can survive
+    assert survivors == list(values)[-len(survivors):]
+
+
+def test_full_probe_window_evicts_least_recently_used(directory):
+    cache = SharedCache("t", 1 << 20, directory=directory, slots=8)  # one probe window
+    for i in range(8):
+        cache.set(f"k{i}", i)
+    for i in range(1, 8):
+        assert cache.get(f"k{i}") == i  # k0 is now the least recently used
+    cache.set("new", "value")
+    assert cache.get("k0") is MISS
+    assert cache.get("new") == "value"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire(directory):
+    cache = SharedCache("t", 1 << 20, directory=directory)
+    cache.set("k", "v", ttl=0.05)
+    assert cache.get("k") == "v"
+    time.sleep(0.1)
+    assert cache.get("k") is MISS
+
+
+def _compute_in_worker(directory, log_path, start):
+    cache = SharedCache("t", 1 << 20, directory=directory)
+    start.wait()
+
+    def compute():
+        with open(log_path, "a") as f:
+            f.write("computed\n")
+        time.sleep(0.3)
+        return "value"
+
+    assert cache.get_or_compute("k", compute) == "value"
+
+
+def test_concurrent_misses_compute_once_across_processes(directory, tmp_path):
+    log_path = str(tmp_path / "computes.log")
+    start = fork.Event()
+    workers = [fork.Process(target=_compute_in_worker, args=(directory, log_path, start)) for _ in range(6)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(10)
+        assert worker.exitcode == 0
+
+    with open(log_path) as f:
+        assert f.read().count("computed") == 1
+    stats = SharedCache("t", 1 << 20, directory=directory).stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 5
+
+
+def _hold_key(directory, started):
+    cache = SharedCache("t", 1 << 20, directory=directory)
+    cache.get_or_compute("k", lambda: (started.set(), time.sleep(2), "slow")[-1])
+
+
+def test_waiter_computes_itself_once_its_wait_budget_is_spent(directory):
+    started = fork.Event()
+    holder = fork.Process(target=_hold_key, args=(directory, started))
+    holder.start()
+    try:
+        assert started.wait(5)
+        cache = SharedCache("t", 1 << 20, directory=directory)
+        set_deadline(0.4)  # waits at most half of it
+        began = time.monotonic()
+        assert cache.get_or_compute("k", lambda: "fast") == "fast"
+        assert time.monotonic() - began < 1.0
+    finally:
+        holder.join(5)
+
+
+def test_refuses_a_directory_others_can_write_to(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    with pytest.raises(PermissionError):
+        SharedCache("t", 1 << 20, directory=str(shared))
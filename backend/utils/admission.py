@@ -0,0 +1,291 @@
+import contextvars
+import functools
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import jsonify, make_response, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# reverse proxies in front of the app whose X-Forwarded-For may be trusted
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", 0))
+
+INTERACTIVE = 0
+BATCH = 1
+
+# (priority, upstreams the route already holds a slot for) of the current request
+_admission = contextvars.ContextVar("admission", default=(INTERACTIVE, frozenset()))
+
+# upstream -> default concurrency limit
+UPSTREAM_LIMITS = {
+    "openai_chat": 16,
+    "openai_embeddings": 16,
+    "openai_tts": 4,
+    "qdrant": 32,
+    "ocr_space": 4,
+}
+
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamPool:
+    """
+    Bounded concurrency for one upstream, with priority classes.
+
+    Waiters are served interactive-first, then in arrival order. Batch work
+    may only hold `batch_limit` of the slots so interactive requests always
+    find headroom. Batch waiters get their own share of the queue so a batch
+    burst cannot fill it. A full queue rejects immediately; a waiter whose
+    deadline passes is rejected as well.
+    """
+
+    def __init__(self, name, limit, max_queue, batch_share=0.5):
+        self.name = name
+        self.limit = limit
+        self.batch_limit = max(1, int(limit * batch_share))
+        self.max_queue = max_queue
+        self.max_batch_queue = max(1, int(max_queue * batch_share))
+        self.queued = {INTERACTIVE: 0, BATCH: 0}
+        self.active = 0
+        self.active_batch = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._avg_hold = 1.0
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    def _has_room(self, priority):
+        if self.active >= self.limit:
+            return False
+        return priority == INTERACTIVE or self.active_batch < self.batch_limit
+
+    def retry_after(self):
+        waves = (len(self._waiters) + 1) / self.limit
+        return max(1, math.ceil(self._avg_hold * waves))
+
+    def acquire(self, priority, timeout):
+        with self._cond:
+            queue_limit = self.max_queue if priority == INTERACTIVE else self.max_batch_queue
+            if self.queued[priority] >= queue_limit:
+                self.stats["rejected"] += 1
+                raise Overloaded(f"{self.name} queue is full", self.retry_after())
+
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            self.queued[priority] += 1
+            deadline = time.monotonic() + timeout
+            while not (self._waiters[0] == ticket and self._has_room(priority)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self.queued[priority] -= 1
+                    self._cond.notify_all()
+                    self.stats["timed_out"] += 1
+                    raise Overloaded(f"{self.name} queue deadline exceeded", self.retry_after())
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiters)
+            self.queued[priority] -= 1
+            self.active += 1
+            if priority == BATCH:
+                self.active_batch += 1
+            self.stats["admitted"] += 1
+            self._cond.notify_all()
+            return time.monotonic()
+
+    def release(self, priority, acquired_at):
+        with self._cond:
+            self.active -= 1
+            if priority == BATCH:
+                self.active_batch -= 1
+            held = time.monotonic() - acquired_at
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "active_batch": self.active_batch,
+                "queued": len(self._waiters),
+                **self.stats,
+            }
+
+
+class SessionRateLimiter:
+    """Token bucket per session: `rate_per_minute` sustained, `burst` at once."""
+
+    def __init__(self, rate_per_minute, burst, max_sessions=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        """Returns 0 if allowed, otherwise seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed = True
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed = False
+            if len(self._buckets) > self.max_sessions:
+                # drop the idlest buckets; they would be full again anyway
+                for stale in sorted(self._buckets, key=lambda k: self._buckets[k][1])[:len(self._buckets) // 10]:
+                    del self._buckets[stale]
+        return 0 if allowed else max(1, math.ceil((1 - tokens) / self.rate))
+
+
+class AdmissionController:
+    def __init__(self, limits=None, max_queue=64, batch_share=0.5,
+                 interactive_wait=10.0, batch_wait=2.0,
+                 rate_per_minute=30, burst=10):
+        limits = limits or UPSTREAM_LIMITS
+        self.pools = {
+            name: UpstreamPool(name, limit, max_queue, batch_share)
+            for name, limit in limits.items()
+        }
+        self.waits = {INTERACTIVE: interactive_wait, BATCH: batch_wait}
+        self.rate_limiter = SessionRateLimiter(rate_per_minute, burst)
+
+    @classmethod
+    def from_env(cls):
+        limits = {
+            name: int(os.getenv(f"ADMISSION_{name.upper()}_LIMIT", default))
+            for name, default in UPSTREAM_LIMITS.items()
+        }
+        return cls(
+            limits,
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", 64)),
+            batch_share=float(os.getenv("ADMISSION_BATCH_SHARE", 0.5)),
+            interactive_wait=float(os.getenv("ADMISSION_INTERACTIVE_WAIT", 10)),
+            batch_wait=float(os.getenv("ADMISSION_BATCH_WAIT", 2)),
+            rate_per_minute=float(os.getenv("SESSION_RATE_PER_MINUTE", 30)),
+            burst=float(os.getenv("SESSION_RATE_BURST", 10)),
+        )
+
+    def acquire(self, upstreams, priority):
+        """Acquires one slot per upstream (in a fixed order) and returns a release callback."""
+        leases = []
+
+        def release():
+            while leases:
+                pool, acquired_at = leases.pop()
+                pool.release(priority, acquired_at)
+
+        deadline = time.monotonic() + self.waits[priority]
+        try:
+            for name in sorted(set(upstreams)):
+                pool = self.pools[name]
+                remaining = max(0.0, deadline - time.monotonic())
+                leases.append((pool, pool.acquire(priority, remaining)))
+        except Overloaded:
+            release()
+            raise
+        return release
+
+    @contextmanager
+    def slot(self, name):
+        """Holds one `name` slot around a single upstream call, unless the route holds one already."""
+        priority, held = _admission.get()
+        if name in held or name not in self.pools:
+            yield
+            return
+        release = self.acquire([name], priority)
+        try:
+            yield
+        finally:
+            release()
+
+    def snapshot(self):
+        return {name: pool.snapshot() for name, pool in self.pools.items()}
+
+
+admission = AdmissionController.from_env()
+
+
+def install_proxy_fix(app, trusted=TRUSTED_PROXIES):
+    """
+    Makes request.remote_addr the client address as seen by the last
+    `trusted` proxies. Without it X-Forwarded-For is ignored: the header is
+    client-controlled.
+    """
+    if trusted:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted)
+
+
+def session_key():
+    """
+    The client's session or user id, or None. Not an address fallback: the
+    frontend sends no id to /tts or /suggestions, and behind a proxy every
+    such request would share the proxy's bucket.
+    """
+    data = request.get_json(silent=True) or {}
+    return (
+        data.get("session_id")
+        or data.get("user_id")
+        or request.form.get("user_id")
+        or None
+    )
+
+
+def too_many_requests(message, retry_after):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def admit(*upstreams, priority=INTERACTIVE, controller=None):
+    """
+    Route decorator: per-session rate limit, then one slot per upstream
+    listed. Those slots are held until the response is closed, so streaming
+    responses keep theirs until the last chunk is sent. Upstreams not listed
+    take a slot only around each call (`AdmissionController.slot`), at this
+    route's priority, so cache hits and CPU-only work hold none.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            ctl = controller or admission
+            session = session_key()
+            wait = ctl.rate_limiter.check(session) if session else 0  # anonymous: pools only
+            if wait:
+                return too_many_requests("Rate limit exceeded for this session", wait)
+            try:
+                release_slots = ctl.acquire(upstreams, priority)
+            except Overloaded as e:
+                return too_many_requests(f"Server busy: {e}", e.retry_after)
+            _admission.set((priority, frozenset(upstreams)))
+
+            def release():
+                release_slots()
+                _admission.set((INTERACTIVE, frozenset()))
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Overloaded as e:
+                release()
+                return too_many_requests(f"Server busy: {e}", e.retry_after)
+            except Exception:
+                release()
+                raise
+            response.call_on_close(release)
+            return response
+        return wrapper
+    return decorator
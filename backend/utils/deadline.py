@@ -0,0 +1,20 @@
+import contextvars
+import os
+import time
+
+DEFAULT_DEADLINE = float(os.getenv("REQUEST_DEADLINE_SECONDS", 30))
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def set_deadline(seconds):
+    _deadline.set(time.monotonic() + seconds)
+
+
+def remaining():
+    deadline = _deadline.get()
+    return DEFAULT_DEADLINE if deadline is None else deadline - time.monotonic()
@@ -0,0 +1,58 @@
+from array import array
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from utils.resilience import ResilientEmbeddings
+from utils.shared_cache import MISS, cache_key, shared_cache
+from utils.usage import MeteredEmbeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Shares embeddings between workers (and between users uploading the same
+    book). Vectors are stored as packed float32; only the texts missing from
+    the cache are sent to `inner`, in one call.
+    """
+
+    def __init__(self, inner, model):
+        self.inner = inner
+        self.model = model
+        self.cache = shared_cache("embeddings")
+
+    def _key(self, text):
+        return cache_key(self.model, text)
+
+    def embed_query(self, text):
+        packed = self.cache.get_or_compute(
+            self._key(text), lambda: array("f", self.inner.embed_query(text)).tobytes()
+        )
+        return array("f", packed).tolist()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        if any(vector is MISS for vector in vectors):
+            # Concurrent uploads of the same book queue here on one lock; the
+            # later ones then find every vector the first one stored.
+            with self.cache.key_lock(cache_key(*keys)):
+                vectors = [self.cache.get(key, count=False) if vector is MISS else vector
+                           for key, vector in zip(keys, vectors)]
+                missing = [i for i, vector in enumerate(vectors) if vector is MISS]
+                if missing:
+                    embedded = self.inner.embed_documents([texts[i] for i in missing])
+                    for i, vector in zip(missing, embedded):
+                        vectors[i] = array("f", vector).tobytes()
+                        self.cache.set(keys[i], vectors[i])
+        return [array("f", packed).tolist() for packed in vectors]
+
+
+def build_embeddings():
+    """
+    OpenAI embeddings as every server uses them, from the outside in:
+    shared cross-worker cache, token metering, then deadline/retry/hedging.
+    Cache hits therefore cost no upstream call and no ledger entry. SDK
+    retries are off so only the resilience layer retries.
+    """
+    base = OpenAIEmbeddings(max_retries=0)
+    return CachedEmbeddings(MeteredEmbeddings(ResilientEmbeddings(base)), model=base.model)
@@ -0,0 +1,130 @@
+import math
+import os
+
+import faiss
+import numpy as np
+
+# auto tiers: (max vectors, kind)
+INDEX_TIERS = [
+    (int(os.getenv("FAISS_FP16_MAX_VECTORS", 1000)), "sq_fp16"),
+    (int(os.getenv("FAISS_SQ8_MAX_VECTORS", 20000)), "sq8"),
+]
+INDEX_KINDS = ("flat", "sq_fp16", "sq8", "ivfpq")
+
+# 8-bit PQ codebooks need at least 256 training vectors.
+IVFPQ_MIN_VECTORS = 256
+IVFPQ_NPROBE = int(os.getenv("FAISS_NPROBE", 16))
+# IVF-PQ returns k * K_FACTOR candidates, re-ranked exactly against the
+# original vectors (see exact_rerank).
+IVFPQ_K_FACTOR = int(os.getenv("FAISS_K_FACTOR", 4))
+
+
+def choose_index_kind(n_vectors, configured="auto"):
+    if configured != "auto":
+        if configured not in INDEX_KINDS:
+            raise ValueError(f"Unknown FAISS index type: {configured}")
+        kind = configured
+    else:
+        kind = next((kind for max_vectors, kind in INDEX_TIERS if n_vectors < max_vectors), "ivfpq")
+    if kind == "ivfpq" and n_vectors < IVFPQ_MIN_VECTORS:
+        return "sq8"  # too few vectors to train PQ; rebuilt as IVF-PQ once the library grows
+    return kind
+
+
+def _pq_subquantizers(dim):
+    # largest divisor of dim giving sub-vectors of at least 8 dims
+    for m in range(dim // 8, 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_index(kind, vectors):
+    """Returns a trained, empty index of the given kind for these vectors."""
+    n, dim = vectors.shape
+    if kind == "flat":
+        return faiss.IndexFlatL2(dim)
+    if kind == "sq_fp16":
+        index = faiss.index_factory(dim, "SQfp16")
+    elif kind == "sq8":
+        index = faiss.index_factory(dim, "SQ8")
+    elif kind == "ivfpq":
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        index = faiss.index_factory(dim, f"IVF{nlist},PQ{_pq_subquantizers(dim)}x8")
+    else:
+        raise ValueError(f"Unknown FAISS index type: {kind}")
+
+    index.train(vectors)
+    if kind == "ivfpq":
+        faiss.extract_index_ivf(index).nprobe = IVFPQ_NPROBE
+    return index
+
+
+def candidate_count(kind, k):
+    """How many neighbours to ask the index for before re-ranking to k."""
+    return k * IVFPQ_K_FACTOR if kind == "ivfpq" else k
+
+
+def search_params(kind, index, ids):
+    """SearchParameters restricting a search to `ids` (index positions)."""
+    selector = faiss.IDSelectorBatch(np.asarray(ids, dtype="int64"))
+    if kind == "ivfpq":
+        # the selected vectors can sit in any list, so probe them all; the
+        # selector is checked before any code is scored
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nlist)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    params.selector_ref = selector  # SWIG does not keep the selector alive
+    return params
+
+
+def exact_rerank(query, vectors, k):
+    """Positions of the k rows of `vectors` closest to `query` by exact L2."""
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    return np.argsort(distances, kind="stable")[:k]
+
+
+def supports_removal(kind):
+    # IVF ids are not renumbered on removal the way langchain's FAISS.delete expects.
+    return kind != "ivfpq"
+
+
+def index_memory_bytes(index):
+    """Resident size from code sizes (serializing would copy the whole index)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # codes plus 8-byte ids in the inverted lists, coarse centroids, 8-bit PQ codebooks
+        return int(ivf.ntotal * (ivf.code_size + 8) + ivf.nlist * ivf.d * 4 + 256 * ivf.d * 4)
+    return int(index.ntotal * index.code_size)
+
+
+def recall_at_k(index, vectors, k=10, sample=100, seed=0, k_factor=1):
+    """
+    Recall@k of `index` against exact L2 search over `vectors` (the same
+    vectors the index holds, in the same order), using a sample of them as
+    queries and ignoring each query's own hit. With k_factor > 1 the index
+    returns that many times more candidates, re-ranked exactly as at query time.
+    """
+    n = len(vectors)
+    if n <= 1:
+        return 1.0
+    k = min(k, n - 1)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(n, size=min(sample, n), replace=False)
+
+    _, approx = index.search(vectors[queries], (k + 1) * k_factor)
+    if k_factor > 1:
+        for row, q in enumerate(queries):
+            found = approx[row][approx[row] != -1]
+            top = found[exact_rerank(vectors[q], vectors[found], k + 1)]
+            approx[row] = np.pad(top, (0, approx.shape[1] - len(top)), constant_values=-1)
+    # ||q - v||^2 = ||q||^2 - 2 q.v + ||v||^2, one (queries x n) matrix
+    norms = (vectors ** 2).sum(axis=1)
+    distances = norms[queries, None] - 2 * vectors[queries] @ vectors.T + norms[None, :]
+
+    hits = 0
+    for row, q in enumerate(queries):
+        exact = [i for i in np.argsort(distances[row])[:k + 1] if i != q][:k]
+        found = [i for i in approx[row] if i != q and i != -1][:k]
+        hits += len(set(exact) & set(found))
+    return hits / (k * len(queries))
@@ -0,0 +1,99 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class HistoryCompactor:
+    """
+    Keeps the history sent to the chains within a token budget.
+
+    Sessions stay plain lists of {"role", "content"} dicts. Once a session
+    goes over `token_budget`, everything except the last `keep_last` messages
+    is folded into a running summary by a background worker and dropped from
+    the list. Until that finishes, `context_for` already sends only the
+    summary plus the recent tail, so the prompt size stays bounded.
+    """
+
+    def __init__(self, summarize, token_budget=3000, keep_last=6,
+                 max_message_tokens=1500, model="gpt-4o"):
+        self.summarize = summarize  # (previous_summary, messages) -> str
+        self.token_budget = token_budget
+        self.keep_last = keep_last
+        self.max_message_tokens = max_message_tokens
+        self.encoding = get_encoding(model)
+        self._summaries = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-compactor")
+
+    def count_tokens(self, messages):
+        # ~4 tokens of framing per chat message, as in OpenAI's cookbook
+        return sum(len(self.encoding.encode(m.get("content", ""))) + 4 for m in messages)
+
+    def _clip(self, message):
+        tokens = self.encoding.encode(message.get("content", ""))
+        if len(tokens) <= self.max_message_tokens:
+            return message
+        clipped = self.encoding.decode(tokens[:self.max_message_tokens])
+        return {**message, "content": clipped + " …[truncated]"}
+
+    def context_for(self, session_id, history):
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            messages = list(history)
+
+        if self.count_tokens(messages) > self.token_budget:
+            messages = messages[-self.keep_last:]
+        context = [self._clip(m) for m in messages]
+        if summary:
+            context.insert(0, {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary}",
+            })
+        return context
+
+    def maybe_compact(self, session_id, history):
+        if len(history) <= self.keep_last or self.count_tokens(history) <= self.token_budget:
+            return
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._executor.submit(contextvars.copy_context().run, self._compact, session_id, history)
+
+    def _compact(self, session_id, history):
+        try:
+            with self._lock:
+                fold_count = len(history) - self.keep_last
+                to_fold = history[:fold_count]
+                previous = self._summaries.get(session_id)
+            if fold_count <= 0:
+                return
+
+            summary = self.summarize(previous, [self._clip(m) for m in to_fold])
+
+            with self._lock:
+                if session_id not in self._pending:
+                    return  # session was reset while summarizing
+                self._summaries[session_id] = summary
+                # Requests only ever append, so the folded prefix is unchanged.
+                del history[:fold_count]
+        except Exception as e:
+            print(f"[history] compaction failed for session {session_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+    def forget(self, session_id):
+        with self._lock:
+            self._summaries.pop(session_id, None)
+            self._pending.discard(session_id)
@@ -0,0 +1,287 @@
+import os
+import tempfile
+import threading
+from uuid import uuid4
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.runnables import RunnableLambda
+
+from utils.faiss_index import (
+    build_index,
+    candidate_count,
+    choose_index_kind,
+    exact_rerank,
+    index_memory_bytes,
+    recall_at_k,
+    search_params,
+    supports_removal,
+)
+
+# "auto" picks fp16 / int8 scalar quantization or IVF-PQ by chunk count.
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+
+
+def build_metadata_filter(filters):
+    """
+    Turns request filters into a FAISS metadata predicate, or None.
+
+    Supported keys: "document_ids" (list), "chapter" (exact title) and
+    "page_range" ([first, last], 1-based and inclusive like the page numbers
+    a reader sees; stored metadata is PyPDF's 0-based "page"). Raises
+    ValueError for malformed filters.
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    document_ids = filters.get("document_ids") or []
+    chapter = filters.get("chapter")
+    page_range = filters.get("page_range")
+    if not isinstance(document_ids, list) or not all(isinstance(i, str) for i in document_ids):
+        raise ValueError("filters.document_ids must be a list of document ids")
+    if chapter is not None and not isinstance(chapter, str):
+        raise ValueError("filters.chapter must be a string")
+    if page_range is not None and not (
+        isinstance(page_range, (list, tuple)) and len(page_range) == 2
+        and all(isinstance(p, int) and not isinstance(p, bool) for p in page_range)
+        and 1 <= page_range[0] <= page_range[1]
+    ):
+        raise ValueError("filters.page_range must be [first, last] with 1 <= first <= last")
+    document_ids = set(document_ids)
+    if not (document_ids or chapter or page_range):
+        return None
+
+    def match(metadata):
+        if document_ids and metadata.get("document_id") not in document_ids:
+            return False
+        if chapter and metadata.get("chapter") != chapter:
+            return False
+        if page_range:
+            page = metadata.get("page")
+            if page is None or not (page_range[0] - 1 <= page <= page_range[1] - 1):
+                return False
+        return True
+
+    match.document_ids = document_ids or None  # lets callers narrow by document first
+    return match
+
+
+class VectorArchive:
+    """
+    The float32 vectors as embedded, keyed by chunk id, in an anonymous temp
+    file read through np.memmap. Rebuilds and the recall baseline use these
+    instead of what a quantized index reconstructs, without keeping a
+    float32 copy on the heap.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile(prefix="library-vectors-")
+        self.rows = {}  # chunk id -> row in the file
+        self.count = 0
+        self.dim = None
+
+    def add(self, ids, vectors):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        self._file.seek(self.count * self.dim * 4)
+        self._file.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        self._file.flush()
+        for offset, chunk_id in enumerate(ids):
+            self.rows[chunk_id] = self.count + offset
+        self.count += len(ids)
+
+    def get(self, ids):
+        if not ids:
+            return np.empty((0, self.dim or 0), dtype="float32")
+        vectors = np.memmap(self._file, dtype="float32", mode="r", shape=(self.count, self.dim))
+        return np.array(vectors[[self.rows[chunk_id] for chunk_id in ids]])
+
+    def remove(self, ids):
+        for chunk_id in ids:
+            self.rows.pop(chunk_id, None)
+        if len(self.rows) < self.count // 2:
+            # compact once most of the file is dead rows
+            live = list(self.rows)
+            vectors = self.get(live)
+            self._file.truncate(0)
+            self.rows, self.count = {}, 0
+            self.add(live, vectors)
+
+
+class UserLibrary:
+    """
+    All documents a user has uploaded, in one FAISS index.
+
+    Documents are added incrementally (only the new chunks are embedded) and
+    can be removed by id. Every chunk carries "document_id" and
+    "document_name" metadata so retrieval can be scoped with filters.
+
+    The index is compressed according to `index_type`. When the library grows
+    into another tier, or a document is removed from an index that cannot
+    delete in place, the index is rebuilt from the original vectors kept in
+    a VectorArchive, which never calls the embeddings API again. IVF-PQ
+    candidates are re-ranked exactly against the same archive.
+    """
+
+    def __init__(self, embeddings, index_type=FAISS_INDEX_TYPE):
+        self.embeddings = embeddings
+        self.index_type = index_type
+        self.index_kind = None
+        self.index_stats = {}
+        self.store = None
+        self.archive = VectorArchive()
+        self.documents = {}  # document_id -> {"name", "chunk_ids", "pages"}
+        self._lock = threading.Lock()
+
+    def add_document(self, name, chunks, pages=None):
+        if not chunks:
+            raise ValueError("A document needs at least one chunk")
+        document_id = uuid4().hex
+        chunk_ids = [uuid4().hex for _ in chunks]
+        for chunk in chunks:
+            chunk.metadata.update(document_id=document_id, document_name=name)
+
+        vectors = np.asarray(
+            self.embeddings.embed_documents([chunk.page_content for chunk in chunks]),
+            dtype="float32",
+        )
+
+        with self._lock:
+            self.archive.add(chunk_ids, vectors)
+            total = len(chunks) + (self.store.index.ntotal if self.store else 0)
+            kind = choose_index_kind(total, self.index_type)
+            if self.store is not None and kind == self.index_kind:
+                self.store.add_embeddings(
+                    zip([chunk.page_content for chunk in chunks], vectors),
+                    metadatas=[chunk.metadata for chunk in chunks],
+                    ids=chunk_ids,
+                )
+                self._update_stats()
+            else:
+                old_chunks, old_ids, old_vectors = self._export()
+                if old_ids:
+                    vectors = np.vstack([old_vectors, vectors])
+                self._build(kind, old_chunks + chunks, old_ids + chunk_ids, vectors)
+            self.documents[document_id] = {
+                "name": name,
+                "chunk_ids": chunk_ids,
+                "pages": pages,
+            }
+        return document_id
+
+    def remove_document(self, document_id):
+        with self._lock:
+            document = self.documents.pop(document_id, None)
+            if document is None:
+                return False
+            if not self.documents:
+                self.store, self.index_kind, self.index_stats = None, None, {}
+            elif supports_removal(self.index_kind):
+                self.store.delete(ids=document["chunk_ids"])
+                self._update_stats()
+            else:
+                removed = set(document["chunk_ids"])
+                chunks, ids, vectors = self._export()
+                keep = [i for i, chunk_id in enumerate(ids) if chunk_id not in removed]
+                self._build(
+                    choose_index_kind(len(keep), self.index_type),
+                    [chunks[i] for i in keep], [ids[i] for i in keep], vectors[keep],
+                )
+            self.archive.remove(document["chunk_ids"])
+            return True
+
+    def _export(self):
+        """(documents, ids, original vectors) currently in the index, in index order."""
+        if self.store is None:
+            return [], [], None
+        ntotal = self.store.index.ntotal
+        ids = [self.store.index_to_docstore_id[i] for i in range(ntotal)]
+        chunks = [self.store.docstore.search(chunk_id) for chunk_id in ids]
+        return chunks, ids, self.archive.get(ids)
+
+    def _build(self, kind, chunks, ids, vectors):
+        index = build_index(kind, vectors)
+        store = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+        )
+        store.add_embeddings(
+            zip([chunk.page_content for chunk in chunks], vectors),
+            metadatas=[chunk.metadata for chunk in chunks],
+            ids=ids,
+        )
+        self.store, self.index_kind = store, kind
+        self.index_stats = {
+            "recall_at_10": 1.0 if kind == "flat" else round(
+                recall_at_k(index, vectors, k_factor=candidate_count(kind, 1)), 4
+            ),
+        }
+        self._update_stats()
+
+    def _update_stats(self):
+        index = self.store.index
+        memory = index_memory_bytes(index)
+        flat_memory = index.ntotal * index.d * 4
+        self.index_stats.update(
+            index_kind=self.index_kind,
+            vectors=index.ntotal,
+            memory_bytes=memory,
+            flat_memory_bytes=flat_memory,
+            compression=round(flat_memory / memory, 2) if memory else None,
+        )
+
+    def is_empty(self):
+        return self.store is None
+
+    def search(self, query, k=4, metadata_filter=None):
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype="float32")
+        with self._lock:
+            if self.store is None:
+                return []
+            index, params = self.store.index, None
+            if metadata_filter is not None:
+                # Pre-filter inside FAISS so a small slice of a large library still gets its k hits.
+                positions = self._matching_positions(metadata_filter)
+                if not positions:
+                    return []
+                params = search_params(self.index_kind, index, positions)
+            _, found = index.search(vector, candidate_count(self.index_kind, k), params=params)
+            ids = [self.store.index_to_docstore_id[i] for i in found[0] if i != -1]
+            if self.index_kind == "ivfpq" and ids:
+                ids = [ids[i] for i in exact_rerank(vector[0], self.archive.get(ids), k)]
+            return [self.store.docstore.search(chunk_id) for chunk_id in ids]
+
+    def _matching_positions(self, metadata_filter):
+        chunk_ids = [
+            chunk_id
+            for document_id, document in self.documents.items()
+            if metadata_filter.document_ids is None or document_id in metadata_filter.document_ids
+            for chunk_id in document["chunk_ids"]
+        ]
+        wanted = {
+            chunk_id for chunk_id in chunk_ids
+            if metadata_filter(self.store.docstore.search(chunk_id).metadata)
+        }
+        return [position for position, chunk_id in self.store.index_to_docstore_id.items() if chunk_id in wanted]
+
+    def as_retriever(self, filters=None, k=4):
+        metadata_filter = build_metadata_filter(filters)  # raises before any search runs
+        return RunnableLambda(
+            lambda query: self.search(query, k, metadata_filter)
+        ).with_config(run_name="library_retriever")
+
+    def list_documents(self):
+        return [{
+            "document_id": document_id,
+            "name": document["name"],
+            "chunks": len(document["chunk_ids"]),
+            "pages": document["pages"],
+        } for document_id, document in self.documents.items()]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.index_stats)
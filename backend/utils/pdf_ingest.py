@@ -0,0 +1,202 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+# === Parallel parsing ===
+def _parse_range(file_path, start, end):
+    # Runs in a worker process: each one opens its own reader.
+    reader = PdfReader(file_path)
+    return [(i, reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+
+def _edge_lines(text, edge):
+    """Indexes of the first and last `edge` non-blank lines of a page."""
+    content = [j for j, line in enumerate(text.splitlines()) if line.strip()]
+    return set(content[:edge] + content[-edge:])
+
+
+def _strip_boilerplate(pages, min_pages=4, min_fraction=0.5, edge=2):
+    """
+    Drops running headers and footers: lines within `edge` lines of the top
+    or bottom of a page that recur there on most pages. Body text is never
+    touched. Digits are normalized away so "Chapter 3 · 41" matches across
+    pages; bare page numbers normalize to "" and are kept.
+    """
+    if len(pages) < min_pages:
+        return pages
+    counts = Counter()
+    for _, text in pages:
+        lines = text.splitlines()
+        counts.update({_normalize(lines[j]) for j in _edge_lines(text, edge)})
+    repeated = {line for line, n in counts.items() if line and n >= min_fraction * len(pages)}
+    stripped = []
+    for i, text in pages:
+        edges = _edge_lines(text, edge)
+        stripped.append((i, "\n".join(
+            line for j, line in enumerate(text.splitlines())
+            if j not in edges or _normalize(line) not in repeated
+        )))
+    return stripped
+
+
+def _chapter_starts(reader):
+    """(start_page, title) for each top-level outline entry, sorted by page."""
+    starts = []
+    try:
+        for item in reader.outline:
+            if isinstance(item, list):
+                continue  # nested entries are sections of the previous chapter
+            starts.append((reader.get_destination_page_number(item), item.title))
+    except Exception:
+        return []
+    return sorted(starts)
+
+
+def _chapter_for(page, starts):
+    chapter = None
+    for start, title in starts:
+        if start > page:
+            break
+        chapter = title
+    return chapter
+
+
+def parse_pdf_parallel(file_path, workers=None, pages_per_task=16, inline_below=32):
+    """
+    Parses a PDF into one Document per page, matching PyPDFLoader's
+    {"source", "page"} metadata plus "chapter" when the PDF has an outline. Page ranges are spread over a process pool;
+    small files are parsed inline where the pool start-up would dominate.
+    Returns (documents, stats).
+    """
+    started = time.perf_counter()
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+    chapters = _chapter_starts(reader)
+    workers = workers or os.cpu_count() or 1
+    ranges = [(s, min(s + pages_per_task, page_count)) for s in range(0, page_count, pages_per_task)]
+
+    pool_size = 1 if page_count < inline_below else min(workers, len(ranges))
+    if pool_size <= 1:
+        pages = _parse_range(file_path, 0, page_count)
+    else:
+        # forked children of a multithreaded server can inherit held locks
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=pool_size, mp_context=context) as pool:
+            futures = [pool.submit(_parse_range, file_path, s, e) for s, e in ranges]
+            pages = [page for future in futures for page in future.result()]
+
+    pages = _strip_boilerplate(pages)
+    documents = []
+    for i, text in pages:
+        if not text.strip():
+            continue
+        metadata = {"source": file_path, "page": i}
+        chapter = _chapter_for(i, chapters)
+        if chapter:
+            metadata["chapter"] = chapter
+        documents.append(Document(page_content=text, metadata=metadata))
+    seconds = time.perf_counter() - started
+    return documents, {
+        "pages": page_count,
+        "parse_seconds": round(seconds, 3),
+        "pages_per_second": round(page_count / seconds, 1) if seconds else None,
+        "workers": max(pool_size, 1),
+    }
+
+
+def _normalize(text):
+    # for header/footer matching: page numbers vary from page to page
+    text = re.sub(r"\d+", "", text.lower())
+    return re.sub(r"\W+", " ", text).strip()
+
+
+# === Near-duplicate chunk elimination ===
+def _dedup_normalize(text):
+    # keeps digits: chunks that differ only in doses or rates are different content
+    return re.sub(r"\W+", " ", text.lower()).strip()
+
+
+def _numbers(text):
+    return tuple(re.findall(r"\d+(?:[.,]\d+)?", text))
+
+
+def _shingles(text, size=5):
+    words = text.split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingles):
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64)
+        # (a * h + b) mod p for every permutation/shingle pair, min over shingles
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+
+def dedup_chunks(chunks, threshold=0.9, num_perm=64, bands=16):
+    """
+    Removes exact duplicates (hash of the normalized text) and near duplicates
+    (MinHash Jaccard estimate >= threshold, candidates found with LSH bands,
+    and the same numbers in the same order). The first occurrence is kept.
+    Returns (kept_chunks, stats).
+    """
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm)
+    seen_hashes = set()
+    buckets = {}
+    signatures = []
+    numbers = []
+    kept = []
+    exact = near = 0
+
+    for chunk in chunks:
+        normalized = _dedup_normalize(chunk.page_content)
+        digest = hashlib.sha1(normalized.encode("utf-8")).digest()
+        if not normalized or digest in seen_hashes:
+            exact += 1
+            continue
+        seen_hashes.add(digest)
+
+        signature = hasher.signature(_shingles(normalized))
+        band_keys = [(b, signature[b * rows:(b + 1) * rows].tobytes()) for b in range(bands)]
+        chunk_numbers = _numbers(chunk.page_content)
+        candidates = {idx for key in band_keys for idx in buckets.get(key, ())}
+        if any(numbers[idx] == chunk_numbers and np.mean(signatures[idx] == signature) >= threshold
+               for idx in candidates):
+            near += 1
+            continue
+
+        idx = len(signatures)
+        signatures.append(signature)
+        numbers.append(chunk_numbers)
+        for key in band_keys:
+            buckets.setdefault(key, []).append(idx)
+        kept.append(chunk)
+
+    total = len(chunks)
+    return kept, {
+        "chunks_in": total,
+        "chunks_out": len(kept),
+        "exact_duplicates": exact,
+        "near_duplicates": near,
+        "dedup_ratio": round((exact + near) / total, 4) if total else 0.0,
+    }
@@ -0,0 +1,177 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import time
+from logging.handlers import RotatingFileHandler
+from uuid import uuid4
+
+from flask import request
+from langchain_core.callbacks import BaseCallbackHandler
+
+RECORD_TRAFFIC = os.getenv("RECORD_TRAFFIC", "0") == "1"
+RECORD_PATH = os.getenv("RECORD_PATH", "traces/traces.jsonl")
+RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", 50 * 1024 * 1024))
+RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", 10))
+
+SECRET_KEYS = {"apikey", "api_key", "authorization", "password", "token", "secret"}
+MAX_STRING = 4000
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_PHONE = re.compile(r"\+?\d[\d\s().-]{7,}\d")
+
+_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def sanitize(value):
+    if isinstance(value, dict):
+        return {
+            k: "[redacted]" if k.lower() in SECRET_KEYS else sanitize(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [sanitize(v) for v in value]
+    if isinstance(value, str):
+        value = _PHONE.sub("[phone]", _EMAIL.sub("[email]", value))
+        return value if len(value) <= MAX_STRING else value[:MAX_STRING] + "…"
+    return value
+
+
+def current_trace():
+    return _trace.get()
+
+
+def note_retrieval(query, docs_and_scores, seconds, final=False):
+    """Called by the retrievers; the last `final=True` call is what the answer saw."""
+    trace = _trace.get()
+    if trace is None:
+        return
+    entry = {
+        "query": sanitize(query),
+        "seconds": round(seconds, 4),
+        "docs": [{
+            "id": doc.metadata.get("_id") or doc.metadata.get("document_id"),
+            "score": None if score is None else float(score),
+            "metadata": {k: v for k, v in doc.metadata.items() if not k.startswith("_")},
+            "content": doc.page_content[:500],
+        } for doc, score in docs_and_scores],
+    }
+    trace["retrievals"].append(entry)
+    if final:
+        trace["retrieved_ids"] = [d["id"] for d in entry["docs"]]
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """Records each chat model call's output and timings into the current trace."""
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        trace = _trace.get()
+        if trace is not None:
+            self._runs[run_id] = {"trace": trace, "started": time.perf_counter(), "first_token": None}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and run["first_token"] is None:
+            run["first_token"] = time.perf_counter()
+            trace = run["trace"]
+            trace["timings"].setdefault("first_token", round(run["first_token"] - trace["_started"], 4))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        ended = time.perf_counter()
+        text = "".join(g.text for gens in response.generations for g in gens)
+        run["trace"]["llm_calls"].append({
+            "output": sanitize(text),
+            "seconds": round(ended - run["started"], 4),
+            "first_token_seconds": None if run["first_token"] is None
+            else round(run["first_token"] - run["started"], 4),
+        })
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+trace_callback = TraceCallbackHandler()
+
+
+class TraceRecorder:
+    """
+    Opt-in (RECORD_TRAFFIC=1) request recorder. Each finished request is
+    handed to `sink`, which by default appends it as one JSON line to a
+    size-rotated file. The replay tool swaps the sink to collect traces.
+    """
+
+    def __init__(self):
+        self.enabled = RECORD_TRAFFIC
+        self.sink = self._write
+        self._logger = None
+
+    def _write(self, trace):
+        if self._logger is None:
+            os.makedirs(os.path.dirname(RECORD_PATH) or ".", exist_ok=True)
+            handler = RotatingFileHandler(RECORD_PATH, maxBytes=RECORD_MAX_BYTES, backupCount=RECORD_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger = logging.getLogger("trace_recorder")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+        self._logger.info(json.dumps(trace, ensure_ascii=False, separators=(",", ":")))
+
+    def install(self, app):
+        if not self.enabled:
+            return
+
+        @app.before_request
+        def _start_trace():
+            # sync/gthread workers reuse the thread's context between requests
+            _trace.set(None)
+            if request.method != "POST":
+                return
+            _trace.set({
+                "id": uuid4().hex,
+                "ts": time.time(),
+                "endpoint": request.path,
+                "inputs": sanitize(request.get_json(silent=True) or request.form.to_dict()),
+                "llm_calls": [],
+                "retrievals": [],
+                "retrieved_ids": [],
+                "timings": {},
+                "_started": time.perf_counter(),
+            })
+
+        @app.after_request
+        def _finish_trace(response):
+            trace = _trace.get()
+            if trace is None:
+                return response
+
+            def finish():
+                trace["timings"]["total"] = round(time.perf_counter() - trace.pop("_started"), 4)
+                trace["status"] = response.status_code
+                if not response.is_streamed:
+                    trace["output"] = sanitize(response.get_data(as_text=True))
+                elif trace["llm_calls"]:
+                    trace["output"] = trace["llm_calls"][-1]["output"]
+                try:
+                    self.sink(trace)
+                except Exception as e:
+                    print(f"[recorder] failed to write trace: {e}")
+
+            # streamed responses are only complete once the body is closed
+            response.call_on_close(finish)
+            return response
+
+        @app.teardown_request
+        def _clear_trace(error=None):
+            # also covers requests where an earlier before_request (e.g. the
+            # usage budget's 429) short-circuited _start_trace
+            _trace.set(None)
+
+
+recorder = TraceRecorder()
@@ -0,0 +1,135 @@
+import contextlib
+import contextvars
+import hashlib
+import time
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Endpoints whose upstream calls all go through the stubbed chat model / vector store.
+# (All POST: the recorder only records POSTs.)
+REPLAYABLE = {"/stream", "/generate", "/start-quiz", "/quiz-feedback-stream", "/mindmap"}
+
+_state = contextvars.ContextVar("replay_state", default=None)
+_options = {"simulate_latency": True}
+
+
+@contextlib.contextmanager
+def replaying(trace):
+    token = _state.set({"trace": trace, "llm": 0, "retrieval": 0})
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def _next(kind):
+    state = _state.get()
+    if state is None:
+        return None
+    recorded = state["trace"]["llm_calls" if kind == "llm" else "retrievals"]
+    if not recorded:
+        return None
+    # Reuse the last recording if the current code makes more calls than were recorded.
+    item = recorded[min(state[kind], len(recorded) - 1)]
+    state[kind] += 1
+    return item
+
+
+def _sleep(seconds):
+    if _options["simulate_latency"] and seconds:
+        time.sleep(seconds)
+
+
+class ReplayChatModel(BaseChatModel):
+    """Stands in for ChatOpenAI: returns the recorded outputs in call order, at the recorded pace."""
+
+    model: str = "replay"
+    model_name: str = "replay"
+    stream_usage: bool = False
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        call = _next("llm") or {"output": "", "seconds": 0}
+        _sleep(call["seconds"])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=call["output"]))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        call = _next("llm") or {"output": "", "seconds": 0}
+        first_token = call.get("first_token_seconds") or 0
+        _sleep(first_token)
+        pieces = [piece + " " for piece in call["output"].split(" ")]
+        pieces[-1] = pieces[-1][:-1]
+        per_piece = max(0.0, call["seconds"] - first_token) / max(len(pieces), 1)
+        for i, piece in enumerate(pieces):
+            if i:
+                _sleep(per_piece)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+
+class ReplayEmbeddings(Embeddings):
+    """Deterministic hash vectors; only used when retrieval is stubbed too."""
+
+    def __init__(self, size=64):
+        self.size = size
+
+    def _vector(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [(digest[i % len(digest)] - 128) / 128 for i in range(self.size)]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        return [self._vector(t) for t in texts]
+
+
+class ReplayVectorStore:
+    """Stands in for langchain_qdrant.Qdrant: serves the recorded retrievals in call order."""
+
+    def __init__(self, *args, **kwargs):
+        self.embeddings = ReplayEmbeddings()
+
+    def similarity_search_with_score_by_vector(self, vector, k=4, **kwargs):
+        retrieval = _next("retrieval") or {"docs": [], "seconds": 0}
+        _sleep(retrieval["seconds"])
+        return [(
+            Document(page_content=doc["content"], metadata={**doc["metadata"], "_id": doc["id"]}),
+            doc["score"],
+        ) for doc in retrieval["docs"][:k]]
+
+
+def install(stub_retrieval=False, simulate_latency=True):
+    """Patches the upstream classes; must run before the Flask app module is imported."""
+    import sys
+    import langchain_openai
+    if "utils.resilience" in sys.modules:
+        # DeadlineChatOpenAI subclasses whatever ChatOpenAI is at import time
+        raise RuntimeError("replay stubs must be installed before utils.resilience is imported")
+    _options["simulate_latency"] = simulate_latency
+    langchain_openai.ChatOpenAI = ReplayChatModel
+    if stub_retrieval:
+        import langchain_qdrant
+        langchain_qdrant.Qdrant = ReplayVectorStore
+
+
+def replay_summary(previous_summary, messages):
+    """Stands in for app.summarize_history (a direct SDK call the recorder does not capture)."""
+    folded = f"[{len(messages)} earlier messages folded during replay]"
+    return f"{previous_summary}\n{folded}" if previous_summary else folded
+
+
+def recall_at_k(recorded_ids, replayed_ids, k):
+    expected = [i for i in recorded_ids[:k] if i is not None]
+    if not expected:
+        return None
+    return len(set(expected) & set(replayed_ids[:k])) / len(expected)
@@ -0,0 +1,371 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from flask import request
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+from langchain_openai import ChatOpenAI
+
+from utils.admission import admission
+from utils.deadline import DEFAULT_DEADLINE, DeadlineExceeded, remaining, set_deadline
+from utils.recorder import note_retrieval
+from utils.shared_cache import cache_key, shared_cache
+
+MAX_DEADLINE = float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", 120))
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+
+# upstream -> per-attempt timeout in seconds
+UPSTREAM_TIMEOUTS = {
+    "openai_chat": 60.0,
+    "openai_embeddings": 10.0,
+    "openai_tts": 30.0,
+    "openai_realtime": 15.0,
+    "qdrant": 10.0,
+    "ocr_space": 30.0,
+}
+
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# === Deadlines ===
+def install_deadlines(app):
+    """Starts a deadline for every request; clients may shorten it with X-Request-Timeout."""
+    @app.before_request
+    def _start_deadline():
+        try:
+            seconds = float(request.headers.get("X-Request-Timeout", DEFAULT_DEADLINE))
+        except ValueError:
+            seconds = DEFAULT_DEADLINE
+        set_deadline(min(max(seconds, 0.0), MAX_DEADLINE))
+
+
+def is_retryable(error):
+    if isinstance(error, (CircuitOpen, DeadlineExceeded)):
+        return False
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or "Timeout" in name or "Connection" in name
+
+
+# === Building blocks ===
+class LatencyTracker:
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q):
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; one trial call after `reset_timeout`."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class Upstream:
+    """
+    Deadline-aware calls to one dependency.
+
+    `fn` receives the per-attempt timeout (the upstream timeout capped by the
+    request's remaining budget). Retryable failures are retried with full
+    jitter backoff while the budget allows. With `hedge=True` (idempotent
+    reads only) a second attempt starts once the first has run longer than
+    the observed p95 latency, and the first success wins.
+    """
+
+    def __init__(self, name, timeout, attempts=3, base_delay=0.2, max_delay=2.0,
+                 min_hedge_delay=0.5):
+        self.name = name
+        self.timeout = timeout
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("CIRCUIT_RESET_SECONDS", 30)),
+        )
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "short_circuited": 0}
+
+    def call(self, fn, hedge=False):
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            # the admission slot covers one attempt, not the backoff sleep
+            with admission.slot(self.name):
+                if not self.breaker.allow():
+                    self.stats["short_circuited"] += 1
+                    raise CircuitOpen(f"{self.name} circuit is open")
+                budget = remaining()
+                if budget <= 0:
+                    raise DeadlineExceeded(f"No time budget left for {self.name}")
+                timeout = min(self.timeout, budget)
+
+                started = time.monotonic()
+                try:
+                    result = self._hedged(fn, timeout) if hedge else fn(timeout)
+                except Exception as e:
+                    if not is_retryable(e):
+                        self.breaker.record_success()  # the upstream answered
+                        raise
+                    self.breaker.record_failure()
+                    error = e
+                else:
+                    self.latency.record(time.monotonic() - started)
+                    self.breaker.record_success()
+                    return result
+
+            attempt += 1
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            if attempt >= self.attempts or delay >= remaining():
+                raise error
+            self.stats["retries"] += 1
+            time.sleep(delay)
+
+    def _hedged(self, fn, timeout):
+        hedge_delay = max(self.min_hedge_delay, self.latency.percentile(0.95) or 0.0)
+        first = _hedge_executor.submit(contextvars.copy_context().run, fn, timeout)
+        done, _ = wait([first], timeout=min(hedge_delay, timeout))
+        if done:
+            return first.result()
+        if hedge_delay >= timeout:
+            raise TimeoutError(f"{self.name} call timed out after {timeout:.1f}s")
+
+        self.stats["hedges"] += 1
+        second = _hedge_executor.submit(contextvars.copy_context().run, fn, timeout - hedge_delay)
+        pending = {first, second}
+        end = time.monotonic() + timeout - hedge_delay
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.stats["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"{self.name} call timed out after {timeout:.1f}s")
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "circuit": self.breaker.state,
+            "p95_seconds": self.latency.percentile(0.95),
+        }
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def upstream(name):
+    with _upstreams_lock:
+        if name not in _upstreams:
+            timeout = float(os.getenv(f"UPSTREAM_{name.upper()}_TIMEOUT", UPSTREAM_TIMEOUTS.get(name, 30.0)))
+            _upstreams[name] = Upstream(name, timeout)
+        return _upstreams[name]
+
+
+def upstream_stats():
+    with _upstreams_lock:
+        return {name: u.snapshot() for name, u in _upstreams.items()}
+
+
+# === Adapters ===
+def http_post(upstream_name, url, **kwargs):
+    """requests.post through the resilience layer; 429/5xx responses are retried."""
+    def attempt(timeout):
+        response = requests.post(url, timeout=timeout, **kwargs)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
+    return upstream(upstream_name).call(attempt)
+
+
+class ResilientEmbeddings(Embeddings):
+    """
+    Wraps a langchain OpenAIEmbeddings (built with max_retries=0): hedged
+    query embeddings and document batches retried one at a time. Each
+    attempt runs on a copy of `inner` that passes the per-attempt timeout to
+    the API call, so an abandoned hedge ends with its own timeout.
+    """
+
+    def __init__(self, inner, upstream_name="openai_embeddings", batch_size=EMBEDDING_BATCH_SIZE):
+        self.inner = inner
+        self.model = inner.model
+        self.upstream_name = upstream_name
+        self.batch_size = batch_size
+
+    def _with_timeout(self, timeout):
+        # model_copy is shallow: the copy shares the SDK client
+        return self.inner.model_copy(update={"model_kwargs": {**self.inner.model_kwargs, "timeout": timeout}})
+
+    def embed_query(self, text):
+        return upstream(self.upstream_name).call(
+            lambda timeout: self._with_timeout(timeout).embed_query(text), hedge=True
+        )
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            vectors.extend(upstream(self.upstream_name).call(
+                lambda timeout: self._with_timeout(timeout).embed_documents(batch)
+            ))
+        return vectors
+
+
+class DeadlineChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI for the LangChain chains. Every request carries the request's
+    remaining budget, capped by the openai_chat per-attempt timeout, as its
+    SDK timeout, and goes through the openai_chat circuit breaker. SDK
+    retries are off. A retried stream would repeat tokens the client has
+    already received, so these calls are not retried.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("max_retries", 0)
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def _timeout():
+        budget = remaining()
+        if budget <= 0:
+            raise DeadlineExceeded("No time budget left for openai_chat")
+        return min(upstream("openai_chat").timeout, budget)
+
+    @staticmethod
+    def _open_circuit():
+        chat = upstream("openai_chat")
+        chat.stats["calls"] += 1
+        if not chat.breaker.allow():
+            chat.stats["short_circuited"] += 1
+            raise CircuitOpen("openai_chat circuit is open")
+        return chat.breaker
+
+    @staticmethod
+    def _record_error(breaker, error):
+        if is_retryable(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success()  # the upstream answered
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        with admission.slot("openai_chat"):
+            kwargs.setdefault("timeout", self._timeout())
+            breaker = self._open_circuit()
+            try:
+                result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as e:
+                self._record_error(breaker, e)
+                raise
+            breaker.record_success()
+            return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        with admission.slot("openai_chat"):
+            kwargs.setdefault("timeout", self._timeout())
+            breaker = self._open_circuit()
+            try:
+                yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except GeneratorExit:
+                breaker.record_success()  # closed early by a client disconnect; the upstream was answering
+                raise
+            except Exception as e:
+                self._record_error(breaker, e)
+                raise
+            breaker.record_success()
+
+
+def qdrant_search(vector_store, vector, k):
+    """Hedged similarity search; Qdrant takes its server-side timeout in whole seconds."""
+    return upstream("qdrant").call(
+        lambda timeout: vector_store.similarity_search_with_score_by_vector(
+            vector, k=k, timeout=max(1, int(timeout))
+        ),
+        hedge=True,
+    )
+
+
+def resilient_retriever(vector_store, k=4):
+    """Drop-in for vector_store.as_retriever() with hedged, deadline-bound searches."""
+    def search(query):
+        started = time.perf_counter()
+
+        def compute():
+            return qdrant_search(vector_store, vector_store.embeddings.embed_query(query), k)
+
+        key = cache_key(getattr(vector_store, "collection_name", ""), k, query)
+        docs_and_scores = shared_cache("retrieval").get_or_compute(key, compute)
+        note_retrieval(query, docs_and_scores, time.perf_counter() - started, final=True)
+        return [doc for doc, _ in docs_and_scores]
+    return RunnableLambda(search).with_config(run_name="resilient_retriever")
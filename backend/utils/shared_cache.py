@@ -0,0 +1,353 @@
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from utils.deadline import remaining
+
+CACHE_DIR = os.getenv("SHARED_CACHE_DIR", os.path.join(tempfile.gettempdir(), f"ivf-shared-cache-{os.getuid()}"))
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE_ENABLED", "1") == "1"
+
+# namespace -> (size limit in MB, default TTL in seconds);
+# SHARED_CACHE_<NAMESPACE>_MB / SHARED_CACHE_<NAMESPACE>_TTL override them
+NAMESPACES = {
+    "embeddings": (128, 30 * 24 * 3600),
+    "retrieval": (16, 3600),
+    "chain": (16, 24 * 3600),
+    "suggestions": (4, 6 * 3600),
+    "quiz": (8, 3600),
+    "ingest": (64, 7 * 24 * 3600),
+}
+
+_MAGIC = b"IVFC"
+_VERSION = 1
+# magic, version, slots, data_start, data_size, cursor, hits, misses, sets, evictions
+_HEADER = struct.Struct("<4sIIQQQQQQQ")
+# key hash, record offset, record length, expires at, last access
+_SLOT = struct.Struct("<QQIdd")
+# key length, flags, crc32 of key + payload
+_RECORD = struct.Struct("<HBI")
+_PROBES = 8
+_KEY_BUCKETS = 65536
+_LOCK_POLL_SECONDS = 0.05
+_COMPRESSED = 1
+_COMPRESS_ABOVE = 1024
+
+MISS = object()
+
+
+def _private_directory(directory):
+    """Values are unpickled from here: only this user may be able to write to it."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(
+            f"Shared cache directory {directory!r} must be a mode 0700 directory owned by uid {os.getuid()}"
+        )
+
+
+class SharedCache:
+    """
+    Cross-process cache for one namespace, backed by a memory-mapped file.
+
+    The file holds a fixed open-addressing slot table and a ring buffer of
+    records. New records are appended at the ring cursor and overwrite the
+    oldest data, which is how the namespace stays within its size limit;
+    stale slots are detected on read by the key and CRC stored with each
+    record. A full probe window evicts its least recently used slot. Values
+    are pickled and zlib-compressed above 1 KiB.
+
+    Writers serialize on a POSIX record lock (per process) plus a thread
+    lock (per thread). `get_or_compute` additionally takes a per-key lock,
+    so concurrent misses across all workers compute a value once. Waiting
+    for that lock is bounded by half the request's remaining budget; after
+    that the waiter computes the value itself.
+    """
+
+    def __init__(self, namespace, max_bytes, ttl=3600, directory=CACHE_DIR, slots=None):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.slots = slots or max(64, max_bytes // 4096)
+        self.data_start = _HEADER.size + self.slots * _SLOT.size
+        self.data_size = max_bytes - self.data_start
+        if self.data_size <= 0:
+            raise ValueError(f"Shared cache {namespace!r} is too small")
+        _private_directory(directory)
+        self.path = os.path.join(directory, f"{namespace}.cache")
+        self._thread_lock = threading.RLock()
+        self._key_locks = {}
+        self._pid = None
+        self._open()
+
+    # === Files & locking ===
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, "r+b")
+        self._lock_file = open(self.path + ".lock", "a+b")
+        os.chmod(self.path + ".lock", 0o600)
+        self._pid = os.getpid()
+        with self._locked():
+            if os.fstat(fd).st_size != self.max_bytes:
+                os.ftruncate(fd, self.max_bytes)
+            self._mm = mmap.mmap(fd, self.max_bytes)
+            header = _HEADER.unpack_from(self._mm, 0)
+            if header[:5] != (_MAGIC, _VERSION, self.slots, self.data_start, self.data_size):
+                self._mm[:self.data_start] = b"\0" * self.data_start
+                _HEADER.pack_into(self._mm, 0, _MAGIC, _VERSION, self.slots,
+                                  self.data_start, self.data_size, 0, 0, 0, 0, 0)
+
+    def _check_fork(self):
+        # mmaps survive fork, but the lock must be re-taken per process
+        if self._pid != os.getpid():
+            self._lock_file = open(self.path + ".lock", "a+b")
+            self._key_locks = {}
+            self._pid = os.getpid()
+
+    class _Lock:
+        def __init__(self, cache, start=0, length=1):
+            self.cache, self.start, self.length = cache, start, length
+
+        def __enter__(self):
+            self.cache._thread_lock.acquire()
+            fcntl.lockf(self.cache._lock_file, fcntl.LOCK_EX, self.length, self.start)
+
+        def __exit__(self, *exc):
+            fcntl.lockf(self.cache._lock_file, fcntl.LOCK_UN, self.length, self.start)
+            self.cache._thread_lock.release()
+
+    def _locked(self):
+        return self._Lock(self)
+
+    # === Layout helpers ===
+    def _header(self):
+        return list(_HEADER.unpack_from(self._mm, 0))
+
+    def _bump(self, field, amount=1):
+        header = self._header()
+        header[field] += amount
+        _HEADER.pack_into(self._mm, 0, *header)
+
+    def _slot_offset(self, index):
+        return _HEADER.size + index * _SLOT.size
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+    def _find(self, key_hash):
+        """(slot index holding key_hash or None, slot index to write into)."""
+        base = key_hash % self.slots
+        now = time.time()
+        free, lru, lru_access = None, None, None
+        for probe in range(_PROBES):
+            index = (base + probe) % self.slots
+            slot_hash, _, _, expires, accessed = _SLOT.unpack_from(self._mm, self._slot_offset(index))
+            if slot_hash == key_hash:
+                return index, index
+            if slot_hash == 0 or expires < now:
+                if free is None:
+                    free = index
+            elif lru_access is None or accessed < lru_access:
+                lru, lru_access = index, accessed
+        return None, free if free is not None else lru
+
+    def _read_record(self, key, offset, length):
+        if length < _RECORD.size or offset + length > self.data_size:
+            return MISS
+        start = self.data_start + offset
+        key_length, flags, crc = _RECORD.unpack_from(self._mm, start)
+        body = self._mm[start + _RECORD.size:start + length]
+        if key_length != len(key) or body[:key_length] != key or zlib.crc32(body) != crc:
+            return MISS  # overwritten by newer records in the ring
+        payload = body[key_length:]
+        if flags & _COMPRESSED:
+            payload = zlib.decompress(payload)
+        return pickle.loads(payload)
+
+    # === Public API ===
+    def get(self, key, count=True):
+        self._check_fork()
+        key = key.encode("utf-8")
+        key_hash = self._hash(key)
+        with self._locked():
+            index, _ = self._find(key_hash)
+            if index is None:
+                if count:
+                    self._bump(7)
+                return MISS
+            slot_offset = self._slot_offset(index)
+            _, offset, length, expires, _ = _SLOT.unpack_from(self._mm, slot_offset)
+            value = MISS if expires < time.time() else self._read_record(key, offset, length)
+            if value is MISS:
+                _SLOT.pack_into(self._mm, slot_offset, 0, 0, 0, 0.0, 0.0)
+                if count:
+                    self._bump(7)
+                return MISS
+            _SLOT.pack_into(self._mm, slot_offset, key_hash, offset, length, expires, time.time())
+            if count:
+                self._bump(6)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._check_fork()
+        key = key.encode("utf-8")
+        payload, flags = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 0
+        if len(payload) > _COMPRESS_ABOVE:
+            payload, flags = zlib.compress(payload, 1), _COMPRESSED
+        body = key + payload
+        length = _RECORD.size + len(body)
+        if length > self.data_size // 4:
+            return False  # would evict too much of the namespace at once
+
+        key_hash = self._hash(key)
+        with self._locked():
+            header = self._header()
+            cursor = header[5]
+            if cursor + length > self.data_size:
+                cursor = 0  # wrap; records never straddle the end
+            start = self.data_start + cursor
+            _RECORD.pack_into(self._mm, start, len(key), flags, zlib.crc32(body))
+            self._mm[start + _RECORD.size:start + length] = body
+
+            index, target = self._find(key_hash)
+            if index is None:
+                existing = _SLOT.unpack_from(self._mm, self._slot_offset(target))
+                if existing[0] and existing[3] >= time.time():
+                    self._bump(9)
+            _SLOT.pack_into(self._mm, self._slot_offset(target), key_hash, cursor, length,
+                            time.time() + ttl, time.time())
+            header = self._header()
+            header[5] = cursor + length
+            header[8] += 1
+            _HEADER.pack_into(self._mm, 0, *header)
+            return True
+
+    def _count(self, hit):
+        with self._locked():
+            self._bump(6 if hit else 7)
+
+    @contextlib.contextmanager
+    def key_lock(self, key):
+        """
+        Serializes work on `key` across threads and workers; yields whether
+        the lock was acquired. One byte of the lock file per key bucket; the
+        lock is polled so a slow or hung holder never blocks past half the
+        remaining request budget.
+        """
+        self._check_fork()
+        bucket = 1 + self._hash(key.encode("utf-8")) % _KEY_BUCKETS
+        with self._thread_lock:
+            thread_lock = self._key_locks.setdefault(bucket, threading.Lock())
+        wait_until = time.monotonic() + max(0.0, remaining() / 2)
+        locked = thread_lock.acquire(timeout=max(0.0, wait_until - time.monotonic()))
+        while locked:
+            try:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, bucket)
+                break
+            except OSError:
+                if time.monotonic() >= wait_until:
+                    thread_lock.release()
+                    locked = False
+                    break
+                time.sleep(_LOCK_POLL_SECONDS)
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, bucket)
+                thread_lock.release()
+
+    def get_or_compute(self, key, compute, ttl=None, should_cache=lambda value: True):
+        # a waiter served by another worker's compute counts as a hit
+        value = self.get(key, count=False)
+        if value is not MISS:
+            self._count(hit=True)
+            return value
+
+        with self.key_lock(key):
+            value = self.get(key, count=False)  # another worker may have filled it meanwhile
+            if value is not MISS:
+                self._count(hit=True)
+                return value
+            self._count(hit=False)
+            value = compute()
+            if should_cache(value):
+                self.set(key, value, ttl)
+            return value
+
+    def stats(self):
+        self._check_fork()
+        with self._locked():
+            header = self._header()
+        hits, misses = header[6], header[7]
+        return {
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "sets": header[8],
+            "evictions": header[9],
+        }
+
+
+class NullCache:
+    """Used when SHARED_CACHE_ENABLED=0 (e.g. by the replay tool): always computes."""
+
+    def get(self, key, count=True):
+        return MISS
+
+    def set(self, key, value, ttl=None):
+        return False
+
+    @contextlib.contextmanager
+    def key_lock(self, key):
+        yield False
+
+    def get_or_compute(self, key, compute, ttl=None, should_cache=lambda value: True):
+        return compute()
+
+    def stats(self):
+        return {"enabled": False}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def shared_cache(namespace):
+    with _caches_lock:
+        if namespace not in _caches:
+            if not SHARED_CACHE_ENABLED:
+                _caches[namespace] = NullCache()
+            else:
+                default_mb, default_ttl = NAMESPACES.get(namespace, (8, 3600))
+                prefix = f"SHARED_CACHE_{namespace.upper()}"
+                mb = float(os.getenv(f"{prefix}_MB", default_mb))
+                ttl = float(os.getenv(f"{prefix}_TTL", default_ttl))
+                try:
+                    _caches[namespace] = SharedCache(namespace, int(mb * 1024 * 1024), ttl=ttl)
+                except PermissionError as e:
+                    print(f"[shared_cache] disabled for {namespace!r}: {e}")
+                    _caches[namespace] = NullCache()
+        return _caches[namespace]
+
+
+def shared_cache_stats():
+    with _caches_lock:
+        caches = dict(_caches)
+    return {namespace: cache.stats() for namespace, cache in caches.items()}
+
+
+def cache_key(*parts):
+    """Stable key for arbitrary text parts (queries, prompts, file hashes)."""
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
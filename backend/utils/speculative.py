@@ -0,0 +1,129 @@
+import contextvars
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from utils.recorder import note_retrieval
+from utils.resilience import qdrant_search
+from utils.shared_cache import cache_key, shared_cache
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def doc_key(doc):
+    return doc.metadata.get("_id") or doc.page_content
+
+
+def reciprocal_rank_fusion(*rankings, c=60):
+    """Fuses ranked (doc, score) lists; ties keep the order of `rankings`."""
+    fused, first_seen = {}, {}
+    for ranking in rankings:
+        for rank, (doc, score) in enumerate(ranking):
+            key = doc_key(doc)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (c + rank + 1)
+            first_seen.setdefault(key, (doc, score))
+    order = sorted(first_seen, key=lambda key: -fused[key])  # stable, so ties stay in order
+    return [first_seen[key] for key in order]
+
+
+class SpeculativeRetriever:
+    """
+    History-aware retriever that does not wait for the query rewrite.
+
+    Retrieval on the raw user input starts in parallel with the rewrite call.
+    When the rewritten query lands, the speculative documents are kept if the
+    two queries are within `similarity_threshold` in embedding space;
+    otherwise a second retrieval runs on the rewrite and both result lists
+    are fused by reciprocal rank (rewrite first on ties). Without chat history no rewrite is needed, which
+    matches create_history_aware_retriever.
+    """
+
+    def __init__(self, llm, vector_store, prompt, k=4, similarity_threshold=0.9):
+        self.vector_store = vector_store
+        self.embeddings = vector_store.embeddings
+        self.rewrite_chain = prompt | llm | StrOutputParser()
+        self.k = k
+        self.similarity_threshold = similarity_threshold
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative-retrieval")
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "speculations": 0,
+            "hits": 0,
+            "merges": 0,
+            "saved_seconds": 0.0,
+        }
+
+    def _search_by_vector(self, vector, query):
+        # keyed by query text so every worker shares the hits; the vector
+        # itself comes from the (also shared) embedding cache
+        key = cache_key(getattr(self.vector_store, "collection_name", ""), self.k, query)
+        return shared_cache("retrieval").get_or_compute(
+            key, lambda: qdrant_search(self.vector_store, vector, self.k)
+        )
+
+    def _search(self, query):
+        started = time.perf_counter()
+        vector = self.embeddings.embed_query(query)
+        search_started = time.perf_counter()
+        docs_and_scores = self._search_by_vector(vector, query)
+        finished = time.perf_counter()
+        note_retrieval(query, docs_and_scores, finished - started)
+        # only the search is saved on a hit: the rewrite is still embedded on the critical path
+        return vector, docs_and_scores, finished - search_started
+
+    def _retrieve(self, inputs, config=None):
+        with self._lock:
+            self.stats["requests"] += 1
+        if not inputs.get("chat_history"):
+            docs_and_scores = self._search(inputs["input"])[1]
+            note_retrieval(inputs["input"], docs_and_scores, 0.0, final=True)
+            return [doc for doc, _ in docs_and_scores]
+
+        # copy the context so the speculative search shares the request deadline
+        speculative = self._executor.submit(contextvars.copy_context().run, self._search, inputs["input"])
+        rewritten = self.rewrite_chain.invoke(inputs, config=config)
+        raw_vector, raw_docs, raw_search_seconds = speculative.result()
+
+        rewritten_vector = self.embeddings.embed_query(rewritten)
+        similarity = cosine_similarity(raw_vector, rewritten_vector)
+
+        with self._lock:
+            self.stats["speculations"] += 1
+            if similarity >= self.similarity_threshold:
+                self.stats["hits"] += 1
+                self.stats["saved_seconds"] += raw_search_seconds
+            else:
+                self.stats["merges"] += 1
+
+        if similarity >= self.similarity_threshold:
+            note_retrieval(rewritten, raw_docs, 0.0, final=True)
+            return [doc for doc, _ in raw_docs]
+
+        started = time.perf_counter()
+        rewritten_docs = self._search_by_vector(rewritten_vector, rewritten)
+        merged = reciprocal_rank_fusion(rewritten_docs, raw_docs)
+        note_retrieval(rewritten, merged[:self.k], time.perf_counter() - started, final=True)
+        return [doc for doc, _ in merged[:self.k]]
+
+    def hit_rate(self):
+        with self._lock:
+            speculations = self.stats["speculations"]
+            return self.stats["hits"] / speculations if speculations else 0.0
+
+    def report(self):
+        with self._lock:
+            report = dict(self.stats)
+        report["hit_rate"] = self.hit_rate()
+        return report
+
+    def as_runnable(self):
+        return RunnableLambda(self._retrieve).with_config(run_name="speculative_retriever")
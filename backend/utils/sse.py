@@ -0,0 +1,111 @@
+import contextvars
+import json
+import queue
+import threading
+import time
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # stop nginx/Render from buffering the stream
+}
+
+_END = object()
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def wants_sse(req, data=None):
+    if (data or {}).get("format") == "sse" or req.args.get("format") == "sse":
+        return True
+    return "text/event-stream" in req.headers.get("Accept", "")
+
+
+def document_sources(docs, snippet_chars=200):
+    return [{
+        "metadata": {k: v for k, v in doc.metadata.items() if not k.startswith("_")},
+        "id": doc.metadata.get("_id"),
+        "snippet": doc.page_content[:snippet_chars],
+    } for doc in docs]
+
+
+def event_stream(events, max_delay=0.05, max_chars=512, heartbeat=15.0):
+    """
+    Turns an iterator of (event, data) tuples into SSE frames.
+
+    Consecutive "token" events (data is a str) are coalesced into one frame
+    until `max_chars` are buffered or `max_delay` seconds pass since the first
+    buffered token. The iterator runs on a producer thread so heartbeats keep
+    flowing while the chain is still retrieving. Any exception from the
+    producer is sent as an "error" event.
+
+    If the client disconnects, the server closes this generator; the producer
+    then stops at the next item and closes `events`, which aborts the
+    upstream stream behind it. The stream always ends with a "done"
+    event carrying the data of any ("done", data) item plus the frame count.
+    """
+    q = queue.Queue()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for item in events:
+                if cancelled.is_set():
+                    break
+                q.put(item)
+        except Exception as e:
+            q.put(("error", {"message": str(e)}))
+        finally:
+            if cancelled.is_set() and hasattr(events, "close"):
+                events.close()
+            q.put(_END)
+
+    # run in a copy of the request's context so deadlines and usage tags carry over
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+
+    try:
+        buffer, buffered_chars, first_buffered = [], 0, None
+        frames, done = 0, {}
+        while True:
+            if buffer:
+                timeout = max(0.0, max_delay - (time.monotonic() - first_buffered))
+            else:
+                timeout = heartbeat
+            try:
+                item = q.get(timeout=timeout)
+            except queue.Empty:
+                if buffer:
+                    yield format_event("token", {"text": "".join(buffer)})
+                    frames += 1
+                    buffer, buffered_chars, first_buffered = [], 0, None
+                else:
+                    yield format_event("heartbeat", {"ts": time.time()})
+                continue
+
+            if item is not _END and item[0] == "token":
+                if not item[1]:
+                    continue
+                if not buffer:
+                    first_buffered = time.monotonic()
+                buffer.append(item[1])
+                buffered_chars += len(item[1])
+                if buffered_chars < max_chars:
+                    continue
+
+            if buffer:
+                yield format_event("token", {"text": "".join(buffer)})
+                frames += 1
+                buffer, buffered_chars, first_buffered = [], 0, None
+
+            if item is _END:
+                yield format_event("done", {**done, "frames": frames})
+                break
+            event, data = item
+            if event == "done":
+                done.update(data)
+            elif event != "token":
+                yield format_event(event, data)
+    finally:
+        # after a normal end the producer is already done; otherwise the client went away
+        cancelled.set()
@@ -0,0 +1,33 @@
+import threading
+from collections import defaultdict
+
+# Appended to partial answers that are saved after the client disconnected.
+TRUNCATED_MARKER = "\n\n[truncated: the trainee stopped this answer]"
+
+
+class StreamMetrics:
+    """Per-endpoint counts of streamed responses that completed or were cancelled by the client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"started": 0, "completed": 0, "cancelled": 0, "cancelled_chars": 0})
+
+    def started(self, endpoint):
+        with self._lock:
+            self._stats[endpoint]["started"] += 1
+
+    def completed(self, endpoint):
+        with self._lock:
+            self._stats[endpoint]["completed"] += 1
+
+    def cancelled(self, endpoint, chars_sent):
+        with self._lock:
+            self._stats[endpoint]["cancelled"] += 1
+            self._stats[endpoint]["cancelled_chars"] += chars_sent
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+
+stream_metrics = StreamMetrics()
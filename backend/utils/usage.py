@@ -0,0 +1,273 @@
+import contextlib
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import jsonify, request
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+from utils.history import get_encoding
+
+LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", "usage_ledger.jsonl")
+# compact the ledger after it grows by this much
+LEDGER_MAX_BYTES = int(os.getenv("USAGE_LEDGER_MAX_BYTES", 16 * 1024 * 1024))
+SESSION_BUDGET_TOKENS = int(os.getenv("USAGE_SESSION_BUDGET_TOKENS", 0))  # 0 = unlimited
+
+# USD per 1M prompt / completion tokens (TTS: per 1M characters)
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+    "tts-1": (15.00, 0.0),
+}
+
+_scope = contextvars.ContextVar("usage_scope", default=("-", "-"))
+
+
+def set_scope(endpoint, session):
+    _scope.set((endpoint or "-", session or "-"))
+
+
+def price_for(model):
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            return PRICES[name]
+    return (0.0, 0.0)
+
+
+def count_tokens(text, model="gpt-4o"):
+    return len(get_encoding(model).encode(text or ""))
+
+
+class UsageLedger:
+    """
+    Append-only JSONL ledger of upstream usage, one short-keyed line per call:
+    {"t": unix time, "e": endpoint, "s": session, "m": model, "k": kind,
+     "p": prompt tokens (characters for TTS), "c": completion tokens}.
+
+    Several workers share the file. Appends hold a shared lockf on
+    `<path>.lock`. Once the file has grown by `max_bytes` since the last
+    compaction, one worker takes the lock exclusively and folds the file
+    into per-day totals per (endpoint, session, model, kind). Folded lines
+    carry "n" (calls), and their "t" is the start of the day (UTC). The
+    compacted file is swapped in atomically, so readers need no lock.
+    Per-session totals for budget checks are read from the file
+    incrementally, so they include every worker's spending.
+    """
+
+    def __init__(self, path=LEDGER_PATH, max_bytes=LEDGER_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._session_tokens = defaultdict(int)
+        self._inode = None
+        self._offset = 0
+        self._compact_at = max_bytes
+
+    @contextlib.contextmanager
+    def _file_lock(self, mode):
+        with open(self.path + ".lock", "a+b") as lock:
+            fcntl.lockf(lock, mode)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def record(self, kind, model, prompt_tokens, completion_tokens=0):
+        endpoint, session = _scope.get()
+        entry = {
+            "t": round(time.time(), 3),
+            "e": endpoint,
+            "s": session,
+            "m": model,
+            "k": kind,
+            "p": int(prompt_tokens),
+            "c": int(completion_tokens),
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+        if size > self._compact_at:
+            self.compact()
+
+    def compact(self):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            if os.path.getsize(self.path) <= self._compact_at:
+                return  # another worker compacted meanwhile
+            totals = defaultdict(lambda: {"n": 0, "p": 0, "c": 0})
+            for entry in self._entries():
+                day = int(entry["t"] // 86400 * 86400)
+                total = totals[(day, entry["e"], entry["s"], entry["m"], entry["k"])]
+                total["n"] += entry.get("n", 1)
+                total["p"] += entry["p"]
+                total["c"] += entry["c"]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for (day, endpoint, session, model, kind), total in sorted(totals.items()):
+                    f.write(json.dumps({"t": day, "e": endpoint, "s": session, "m": model, "k": kind,
+                                        **total}, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, self.path)
+            self._compact_at = os.path.getsize(self.path) + self.max_bytes
+
+    def _entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # torn line from a crash mid-write
+
+    def _catch_up(self):
+        """Adds the lines any worker appended since the last read; starts over after a compaction."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            info = os.fstat(f.fileno())
+            if info.st_ino != self._inode or info.st_size < self._offset:
+                if self._inode is not None:  # compacted by some worker
+                    self._compact_at = max(self._compact_at, info.st_size + self.max_bytes)
+                self._inode, self._offset = info.st_ino, 0
+                self._session_tokens.clear()
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # a line still being written is read next time
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._session_tokens[entry["s"]] += entry["p"] + entry["c"]
+        self._offset += end
+
+    def session_tokens(self, session):
+        with self._lock:
+            self._catch_up()
+            return self._session_tokens.get(session, 0)
+
+    def summary(self, group_by="endpoint", since=None):
+        """Totals per group. `since` is exact for recent lines and per day for compacted ones."""
+        key = {"endpoint": "e", "session": "s", "model": "m", "kind": "k"}[group_by]
+        groups = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+        for entry in self._entries():
+            if since and entry["t"] < since and not (entry.get("n") and entry["t"] + 86400 > since):
+                continue
+            group = groups[entry[key]]
+            prompt_price, completion_price = price_for(entry["m"])
+            group["calls"] += entry.get("n", 1)
+            group["prompt_tokens"] += entry["p"]
+            group["completion_tokens"] += entry["c"]
+            group["cost_usd"] += (entry["p"] * prompt_price + entry["c"] * completion_price) / 1e6
+        for group in groups.values():
+            group["cost_usd"] = round(group["cost_usd"], 6)
+        return dict(sorted(groups.items(), key=lambda item: -item[1]["cost_usd"]))
+
+
+ledger = UsageLedger()
+
+
+def record_response_usage(response, kind="chat", model=None):
+    """Records the usage block of an OpenAI SDK response (chat completions or Responses API)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", 0)
+    completion = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", 0)
+    ledger.record(kind, model or getattr(response, "model", "unknown"), prompt, completion)
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records chat model usage from LangChain runs. Uses the usage the API
+    reports (ChatOpenAI needs stream_usage=True for streamed runs) and falls
+    back to tiktoken counts of the prompt and streamed tokens.
+    """
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        model = (kwargs.get("invocation_params") or {}).get("model_name") \
+            or (kwargs.get("invocation_params") or {}).get("model", "unknown")
+        text = "\n".join(str(m.content) for batch in messages for m in batch)
+        self._runs[run_id] = {"model": model, "prompt_text": text, "completion": []}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None:
+            run["completion"].append(token)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None) or {"model": "unknown", "prompt_text": "", "completion": []}
+        model = (response.llm_output or {}).get("model_name") or run["model"]
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or usage
+        if not usage:
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            if token_usage:
+                usage = {"input_tokens": token_usage.get("prompt_tokens", 0),
+                         "output_tokens": token_usage.get("completion_tokens", 0)}
+        if usage:
+            ledger.record("chat", model, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+        else:
+            completion_text = "".join(run["completion"]) or "".join(
+                g.text for gens in response.generations for g in gens
+            )
+            ledger.record("chat", model, count_tokens(run["prompt_text"], model),
+                          count_tokens(completion_text, model))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            # the prompt was still sent (and billed) even if the stream failed
+            ledger.record("chat", run["model"], count_tokens(run["prompt_text"], run["model"]),
+                          count_tokens("".join(run["completion"]), run["model"]))
+
+
+usage_callback = UsageCallbackHandler()
+
+
+class MeteredEmbeddings(Embeddings):
+    """The embeddings API response is not exposed by langchain, so inputs are counted with tiktoken."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.model = getattr(inner, "model", "text-embedding-ada-002")
+
+    def embed_query(self, text):
+        ledger.record("embedding", self.model, count_tokens(text, self.model))
+        return self.inner.embed_query(text)
+
+    def embed_documents(self, texts):
+        ledger.record("embedding", self.model, sum(count_tokens(t, self.model) for t in texts))
+        return self.inner.embed_documents(texts)
+
+
+def install_usage_tracking(app, session_key):
+    """Tags usage with the request's endpoint and session, and enforces the per-session budget."""
+    @app.before_request
+    def _usage_scope():
+        session = session_key()
+        set_scope(request.path, session)
+        # anonymous requests are not budgeted: they would all share one key
+        if SESSION_BUDGET_TOKENS and session and ledger.session_tokens(session) >= SESSION_BUDGET_TOKENS:
+            return jsonify({
+                "error": "Token budget exhausted for this session",
+                "budget_tokens": SESSION_BUDGET_TOKENS,
+            }), 429
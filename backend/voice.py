@@ -1,19 +1,25 @@
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
-import requests
 import os
 import json
 import logging
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
 from langchain_qdrant import Qdrant
 import qdrant_client
 from prompts.system_prompt import SYSTEM_PROMPT
+from utils.admission import admit, install_proxy_fix, session_key
+from utils.embeddings import build_embeddings
+from utils.resilience import http_post, install_deadlines, qdrant_search
+from utils.shared_cache import cache_key, shared_cache
+from utils.usage import install_usage_tracking
 
 # Load environment variables from .env
 load_dotenv()
 
 app = Flask(__name__)
+install_proxy_fix(app)
+install_deadlines(app)
+install_usage_tracking(app, session_key)
 
 CORS(app, resources={
     r"/api/*": {
@@ -42,12 +48,12 @@ def get_vector_store():
     client = qdrant_client.QdrantClient(
         url=os.getenv("QDRANT_HOST"),
         api_key=os.getenv("QDRANT_API_KEY"),
+        timeout=float(os.getenv("QDRANT_TIMEOUT", 10)),
     )
-    embeddings = OpenAIEmbeddings()
     vector_store = Qdrant(
         client=client,
         collection_name=os.getenv("QDRANT_COLLECTION_NAME"),
-        embeddings=embeddings,
+        embeddings=build_embeddings(),
     )
     return vector_store
 
@@ -58,6 +64,7 @@ def home():
     return "Flask API is running!"
 
 @app.route('/api/rtc-connect', methods=['POST'])
+@admit("openai_chat")
 def connect_rtc():
     try:
         client_sdp = request.get_data(as_text=True)
@@ -74,7 +81,7 @@ def connect_rtc():
             "Authorization": f"Bearer {OPENAI_API_KEY}",
             "Content-Type": "application/json"
         }
-        session_resp = requests.post(OPENAI_SESSION_URL, headers=headers, json=session_payload)
+        session_resp = http_post("openai_realtime", OPENAI_SESSION_URL, headers=headers, json=session_payload)
         if not session_resp.ok:
             logger.error(f"Session create failed: {session_resp.text}")
             return Response("Failed to create realtime session", status=500)
@@ -90,7 +97,8 @@ def connect_rtc():
             "Authorization": f"Bearer {ephemeral_token}",
             "Content-Type": "application/sdp"
         }
-        sdp_resp = requests.post(
+        sdp_resp = http_post(
+            "openai_realtime",
             OPENAI_API_URL,
             headers=sdp_headers,
             params={
@@ -111,6 +119,7 @@ def connect_rtc():
         return Response(f"Error: {e}", status=500)
 
 @app.route('/api/search', methods=['POST'])
+@admit("openai_embeddings", "qdrant")
 def search():
     try:
         query = request.json.get('query')
@@ -118,7 +127,12 @@ def search():
             return jsonify({"error": "No query provided"}), 400
 
         logger.info(f"Searching for: {query}")
-        results = vector_store.similarity_search_with_score(query, k=3)
+
+        def compute():
+            return qdrant_search(vector_store, vector_store.embeddings.embed_query(query), 3)
+
+        key = cache_key(vector_store.collection_name, 3, query)
+        results = shared_cache("retrieval").get_or_compute(key, compute)
 
         formatted = [{
             "content": doc.page_content,